@@ -0,0 +1,54 @@
+import concurrent.futures
+import functools
+import os
+import traceback
+
+import timings
+
+
+# Convert a single file, errors are returned instead of raised
+# (SystemExit too, as the converters exit on some errors)
+def run_one(func, path):
+    try:
+        return path, func(path), None
+    except (Exception, SystemExit):
+        return path, None, traceback.format_exc()
+
+
+# Run func(path) for every path, spread across a pool of worker processes if jobs > 1
+# (jobs = 0 means one worker per CPU)
+# The initializer runs once in every worker, e.g. to load the mappings
+# Yields (path, result, error) in the same order as the paths
+# If a report (dict) is given, the stage timings of every converted file are added to it
+def run_batch(func, paths, jobs=1, initializer=None, initargs=(), report=None):
+    if report is not None:
+        for path, result, error in run_batch(functools.partial(timings.measure, func), paths, jobs, initializer, initargs):
+            if error is None:
+                result, report[path] = result
+            yield path, result, error
+        return
+
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    if jobs <= 1 or len(paths) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for path in paths:
+            yield run_one(func, path)
+        return
+
+    jobs = min(jobs, len(paths))
+    chunksize = max(1, len(paths) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=initializer,
+            initargs=initargs) as executor:
+        yield from executor.map(functools.partial(run_one, func), paths,
+            chunksize=chunksize)
+
+
+# Print the summary of the failed files, returns the exit status
+def summarize(failed, total):
+    if failed:
+        print("%d of %d file(s) failed" % (failed, total))
+        return 1
+    return 0
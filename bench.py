@@ -0,0 +1,331 @@
+import argparse
+import functools
+import glob
+import io
+import json
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import time
+import timeit
+
+import main as main0
+import main1
+import main2
+import script_ir
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+# The offsets are 16 bit, so markers can only be placed in the first 64 KiB
+MAX_MARKER_OFFSET = 0xFFFF
+
+ASCII_TEXT = "abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ,.!?'"
+NON_ASCII_TEXT = "\u3042\u3044\u3046\u30a2\u30a4\u4e00\u4eba\u65e5\u672c\u8a9e\u3001\u3002\u300c\u300d\u00e4\u00f6\u00fc\u00e9\u2026"
+
+
+# Build a synthetic GS4 script payload (offset table + UTF-16LE body) of about `size` bytes
+# Every command of the mappings table is followed by its parameters and about `text_length` characters of
+# dialogue text (a `non_ascii` part of it Japanese/accented), `sections` commands start a section and
+# `refs` parameters get a reference
+def make_script(size=1 << 16, text_length=20, non_ascii=0.0, sections=20, refs=10, seed=0):
+    rng = random.Random(seed)
+    commands = [(int(opcode[1:-1]), argument_range[0])
+                for opcode, (_, argument_range) in main2.get_mapping_table(main2.MAPPINGS_FILE).forward.items()]
+
+    units = []
+    command_positions = []
+    parameter_positions = []
+    while len(units) * 2 < size:
+        opcode, num_parameters = rng.choice(commands)
+        command_positions.append(len(units))
+        units.append(opcode)
+        for j in range(num_parameters):
+            if j == 0:
+                parameter_positions.append(len(units))
+            units.append(rng.randint(0, 30))
+        for _ in range(rng.randint(0, text_length * 2)):
+            units.append(ord(rng.choice(NON_ASCII_TEXT if rng.random() < non_ascii else ASCII_TEXT)))
+
+    # The markers are spread evenly over the positions the offsets can reach
+    header_size = 4 + 4 * (sections + refs)
+    def spread(positions, count):
+        positions = [p for p in positions if header_size + p * 2 <= MAX_MARKER_OFFSET]
+        return sorted(set(positions[i * len(positions) // count] for i in range(count))) if positions and count else []
+    section_positions = spread(command_positions, sections)
+    ref_positions = spread(parameter_positions, refs)
+
+    # The offsets are in bytes, from the start of the payload (including the table)
+    header_size = 4 + 4 * (len(section_positions) + len(ref_positions))
+    values = [len(section_positions) + len(ref_positions), 0]
+    for index in section_positions:
+        values += [header_size + index * 2, 0]
+    for index in ref_positions:
+        values += [header_size + index * 2, 1]
+    return struct.pack(f"<{len(values)}H", *values) + struct.pack(f"<{len(units)}H", *units)
+
+
+# Wrap a GS4 script payload into the USR/RSZ container
+def make_container(payload):
+    of = io.BytesIO()
+    main1.encode_usr(of, payload)
+    return of.getvalue()
+
+
+# The per character marker lookup the decoder used before (two binary searches for every character)
+def markers_binary_search(text, sections_zero, sections_one):
+    found = 0
+    byte_position = 0
+    for char in text:
+        if script_ir.is_position_in_list(byte_position, sections_zero):
+            found += 1
+        if script_ir.is_position_in_list(byte_position, sections_one):
+            found += 1
+        byte_position += 2
+    return found
+
+
+# The marker cursor the decoder uses now (one comparison for every character)
+def markers_cursor(text, sections_zero, sections_one):
+    markers = script_ir.merge_markers(sections_zero, sections_one, len(text))
+    markers.append((len(text), None))
+    found = 0
+    marker_index = 0
+    next_marker = markers[0][0]
+    for index, char in enumerate(text):
+        while index == next_marker:
+            found += 1
+            marker_index += 1
+            next_marker = markers[marker_index][0]
+    return found
+
+
+# Time a function (best of the repeats), returns nanoseconds per character
+def time_per_char(func, num_chars, repeat):
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    return best * 1e9 / num_chars
+
+
+# Write a synthetic script of about size_mb megabytes (the body of a smaller script repeated)
+def write_large_script(path, size_mb):
+    data = make_script(1 << 17)
+    body = data[4 + 4 * struct.unpack_from("<H", data)[0]:]
+    with open(path, "wb") as f:
+        f.write(data)
+        for _ in range(size_mb * (1 << 20) // len(body)):
+            f.write(body)
+
+
+# Peak RSS of this process in megabytes
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+# The conversions the users run on a large script, in this order: wrap the .bin file in a container,
+# then decode the .bin file and the container (name, conversion of the .bin file)
+# The peak RSS only goes up, so every stage is checked against the peak of the ones before it
+MEMORY_STAGES = [
+    ("main1 encode", lambda input_file: main1.convert_file(input_file, 'e')),
+    ("main2.decode_file", main2.decode_file),
+    ("main.decode", lambda input_file: main0.decode(os.path.splitext(input_file)[0])),
+]
+
+
+# Convert a large synthetic script from file to file, and check how much the peak RSS grew at every stage
+def check_memory(size_mb, max_rss_mb):
+    if resource is None:
+        print("Peak RSS can't be measured on this platform")
+        return 0
+
+    # Load the mappings and the character classes first, they aren't part of the decoding
+    main2.preprocess_mappings(main2.MAPPINGS_FILE)
+    script_ir.get_char_class_table()
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_file = os.path.join(temp_dir, "large.user.2.en.bin")
+        write_large_script(input_file, size_mb)
+        print(f"Converting {os.path.getsize(input_file) / (1 << 20):.1f} MB")
+
+        for name, convert in MEMORY_STAGES:
+            rss_before = peak_rss_mb()
+            convert(input_file)
+            rss_growth = peak_rss_mb() - rss_before
+
+            print(f"{name:<20}peak RSS {rss_before + rss_growth:.1f} MB (grew by {rss_growth:.1f} MB)")
+            if rss_growth > max_rss_mb:
+                print(f"{name}: peak RSS grew by more than {max_rss_mb} MB")
+                failed = 1
+
+    return failed
+
+
+# The conversion stages, in the order they run on the files of the suite:
+# (name, pattern of the input files, conversion of one file)
+STAGES = [
+    ("main1 decode", "*.user.2.en", lambda path: main1.convert_file(path, 'd')),
+    ("main2 decode", "*.user.2.en.bin", main2.decode_file),
+    ("main2 encode", "*.user.2.en.txt", main2.encode_file),
+    ("main1 encode", "*.user.2.en.bin", lambda path: main1.convert_file(path, 'e')),
+]
+
+
+# Convert synthetic containers through every stage, and time each stage (best of the repeats)
+# With unicode the main2 stages use --unicode
+def run_suite(files, repeat, unicode=False, **script_options):
+    main2.preprocess_mappings(main2.MAPPINGS_FILE)
+    script_ir.get_char_class_table()
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i in range(files):
+            with open(os.path.join(temp_dir, f"bench{i:04d}.user.2.en"), "wb") as f:
+                f.write(make_container(make_script(seed=i, **script_options)))
+
+        for name, pattern, convert in STAGES:
+            if unicode and name.startswith("main2"):
+                convert = functools.partial(convert, unicode=True)
+            paths = sorted(glob.glob(os.path.join(temp_dir, pattern)))
+            size = sum(os.path.getsize(path) for path in paths)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for path in paths:
+                    convert(path)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results.append({
+                "stage": name,
+                "files": len(paths),
+                "bytes": size,
+                "seconds": best,
+                "mb_per_s": size / (1 << 20) / best,
+                "files_per_s": len(paths) / best,
+            })
+    return results
+
+
+def print_results(results, baseline=None):
+    previous = {result["stage"]: result for result in baseline["results"]} if baseline else {}
+    print(f"{'stage':<16}{'files':>7}{'MB':>9}{'MB/s':>9}{'files/s':>10}" + ("   vs baseline" if previous else ""))
+    for result in results:
+        line = (f"{result['stage']:<16}{result['files']:>7}{result['bytes'] / (1 << 20):>9.2f}"
+                f"{result['mb_per_s']:>9.2f}{result['files_per_s']:>10.1f}")
+        if result["stage"] in previous:
+            line += f"   {result['mb_per_s'] / previous[result['stage']]['mb_per_s']:.2f}x"
+        print(line)
+
+
+# The per character timings of the decoder parts
+def run_micro(repeat, **script_options):
+    data = make_script(**script_options)
+    main2.preprocess_mappings(main2.MAPPINGS_FILE)
+    sections_zero, sections_one = script_ir.read_position_values(data)
+    text = data.decode("utf-16le", errors="replace")
+    script = main2.disassemble_script(data)
+    decoded = main2.decode_script(data)
+    unicode_text = main2.convert_decimal_to_unicode(decoded)
+    print(f"{len(text)} characters, {len(sections_zero)} sections, {len(sections_one)} references")
+
+    results = [
+        ("markers (binary search)", lambda: markers_binary_search(text, sections_zero, sections_one)),
+        ("markers (cursor)", lambda: markers_cursor(text, sections_zero, sections_one)),
+        ("classify_runs (numpy)" if main2.numpy is not None else "classify_runs (regex)", lambda: main2.classify_runs(text)),
+        ("decode_script", lambda: main2.decode_script(data)),
+        ("convert_decimal_to_unicode", lambda: main2.convert_decimal_to_unicode(decoded)),
+        ("convert_to_decimal", lambda: main2.convert_to_decimal(unicode_text)),
+        ("disassemble_script", lambda: main2.disassemble_script(data)),
+        ("assemble", lambda: script_ir.assemble(script)),
+    ]
+    for name, func in results:
+        print(f"{name:<28}{time_per_char(func, len(text), repeat):8.1f} ns/char")
+
+
+# The parameter conversion helpers, with a typical input each
+HELPERS = [
+    ("find_and_add_delimiters", lambda: main2.find_and_add_delimiters("\\L12354\\L12356|\\3|abc")),
+    ("count_backslashes_with_numbers", lambda: main2.count_backslashes_with_numbers("\\L1|\\2|\\L30|text", 3)),
+    ("replace_single_backslashes", lambda: main2.replace_single_backslashes("\\1|\\2|\\ab", 2)),
+    ("remove_l_prefix", lambda: main2.remove_l_prefix("\\person|", "\\L1|\\L2|\\L3|abc", 3, main2.MAPPINGS_FILE, False)),
+    ("fix_first_line_text", lambda: main2.fix_first_line_text("\\1|ab\\2|cd\\L3|ef\\4|{REF 1}g\nsecond line\n")),
+    ("convert_decimal_to_unicode", lambda: main2.convert_decimal_to_unicode("\\L12354|\\L12356|abc\\L12358|\\3|")),
+    ("encode_gs4_text", lambda: main2.encode_gs4_text("\\57374|\\1|\\2|\\3|Hello\\L12354|[U+3042]\\10|")),
+]
+
+
+# The time of every parameter conversion helper call
+def run_helpers(repeat, number=10000):
+    main2.preprocess_mappings(main2.MAPPINGS_FILE)
+    for name, func in HELPERS:
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        print(f"{name:<32}{best * 1e6 / number:8.2f} us/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the GS4 script conversion on synthetic scripts")
+    parser.add_argument("--files", type=int, default=50, help="Number of synthetic script files (optional)")
+    parser.add_argument("--size", type=int, default=64, metavar="KB", help="Size of every script in KiB (optional)")
+    parser.add_argument("--text-length", type=int, default=20, help="Average number of text characters after each command (optional)")
+    parser.add_argument("--non-ascii", type=float, default=0.0, help="Part of the text that is not ASCII, 0 to 1 (optional)")
+    parser.add_argument("--sections", type=int, default=20, help="Number of SECTION markers in every script (optional)")
+    parser.add_argument("--refs", type=int, default=10, help="Number of REF markers in every script (optional)")
+    parser.add_argument("--unicode", action="store_true", help="Decode and encode the scripts with --unicode (optional)")
+    parser.add_argument("--cjk", action="store_true", help="Use non-ASCII (mostly Japanese) text only, the same as --non-ascii 1 --unicode (optional)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs, the best one is reported (optional)")
+    parser.add_argument("--output", type=str, help="Save the results to this JSON file (optional)")
+    parser.add_argument("--baseline", type=str, help="Compare with the results in this JSON file (optional)")
+    parser.add_argument("--micro", action="store_true", help="Time the decoder parts per character on one script instead (optional)")
+    parser.add_argument("--helpers", action="store_true", help="Time the parameter conversion helpers per call instead (optional)")
+    parser.add_argument("--memory", type=int, metavar="MB", help="Check the peak RSS of encoding and decoding a script of this many megabytes instead (optional)")
+    parser.add_argument("--max-rss", type=int, default=32, metavar="MB", help="Allowed peak RSS growth for --memory (optional)")
+    args = parser.parse_args()
+
+    if args.memory:
+        sys.exit(check_memory(args.memory, args.max_rss))
+
+    script_options = {
+        "size": args.size * 1024,
+        "text_length": args.text_length,
+        "non_ascii": 1.0 if args.cjk else args.non_ascii,
+        "sections": args.sections,
+        "refs": args.refs,
+    }
+
+    if args.micro:
+        run_micro(args.repeat, **script_options)
+        return
+
+    if args.helpers:
+        run_helpers(args.repeat)
+        return
+
+    results = run_suite(args.files, args.repeat, args.unicode or args.cjk, **script_options)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        report = {
+            "options": dict(script_options, files=args.files, repeat=args.repeat, unicode=args.unicode or args.cjk),
+            "python": platform.python_version(),
+            "numpy": main2.numpy is not None,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,229 @@
-import os
+import argparse
+import functools
+import glob
+import io
+import os.path
 import sys
+import time
+import traceback
+
+import batch
+import main1
+import main2
+import manifest
+import timings
+
+
+DESCRIPTION = """Decode and encode AJ:AA Trilogy GS4 (Apollo Justice) script files."""
+
+
+# Decode a GS4 script file (*.user.2.*) to the readable format (*.user.2.*.txt)
+def decode(path, unicode=False, noasciiconv=False, nolparam=False):
+    with open(path, 'rb') as f:
+        data = main1.decode_usr(f)
+
+    if isinstance(data, dict):
+        raise ValueError("not a gs4 script file")
+
+    pieces = main2.iter_decode_script(data, asciiconv=noasciiconv,
+        lparam=nolparam, unicode=unicode)
+
+    out = path + '.txt'
+    main2.write_script_pieces(out, pieces, unicode)
+    return out
+
+
+# Encode a readable GS4 script (*.user.2.*.txt) back to the script file
+def encode(path, unicode=False):
+    if not path.endswith('.txt'):
+        raise ValueError("unknown file extension (must be .txt)")
+
+    text = main2.read_script_text(path, unicode)
+    data = main2.encode_script(text, unicode=unicode)
+    if data is None:
+        raise ValueError("script can't be encoded")
+
+    of = io.BytesIO()
+    main1.encode_usr(of, data)
+
+    out = path.rsplit('.', 1)[0]
+    main2.write_file_atomic(out, [of.getvalue()])
+    return out
+
+
+# Convert one file in the given direction ('d' = decode, 'e' = encode)
+# Returns the path of the written file
+def convert(path, direction, unicode=False, noasciiconv=False, nolparam=False):
+    if direction == 'd':
+        return decode(path, unicode, noasciiconv, nolparam)
+    elif direction == 'e':
+        return encode(path, unicode)
+    else:
+        raise ValueError("unknown direction %s (must be d or e)" % repr(direction))
+
+
+# Size and modification time of a file (None if it's gone)
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+# Watch the readable GS4 scripts (*.user.2.*.txt) matching the pattern, and
+# encode every one that is saved, until interrupted
+# The files are polled every `interval` seconds, and a file is only encoded
+# once it hasn't changed for `debounce` seconds (editors often save in bursts)
+def watch(pattern, unicode=False, interval=0.1, debounce=0.2):
+    # Load the mappings once, they stay in memory for every encode
+    main2.preprocess_mappings(main2.MAPPINGS_FILE)
+
+    stamps = {p: file_stamp(p) for p in glob.glob(pattern)}
+    changed = {} # path -> time of the last change seen
+    print("Watching %d file(s), press Ctrl+C to stop" % len(stamps))
+
+    while True:
+        now = time.monotonic()
+        paths = glob.glob(pattern)
+        for p in paths:
+            stamp = file_stamp(p)
+            if stamp is not None and stamp != stamps.get(p):
+                stamps[p] = stamp
+                changed[p] = now
+        for p in set(stamps) - set(paths):
+            del stamps[p]
+            changed.pop(p, None)
+
+        for p, last_change in list(changed.items()):
+            if now - last_change < debounce:
+                continue
+            del changed[p]
+
+            start = time.perf_counter()
+            try:
+                out = encode(p, unicode)
+            except Exception:
+                print("error with file %s:\n%s" % (p, traceback.format_exc()))
+            else:
+                print("encoded %s -> %s (%.0f ms)" % (
+                    p, out, (time.perf_counter() - start) * 1000))
+
+        time.sleep(interval)
 
 
-if len(sys.argv) > 0:
+if __name__ == '__main__':
     print("AJAAT GS4 SCRIPT CONVERTER")
     print("Example decode: python main.py d <file>")
     print("Example encode: python main.py e <file>")
-
-
-de = sys.argv[1]
-file = sys.argv[2]
-
-
-l = []
-l.append("@echo off")
-l.append("color 2")
-l.append("cls")
-
-if de == 'd':
-    l.append('echo Decoding...')
-    l.append(f'python main1.py d {file}')
-    l.append(f'python main2.py decode {file}.bin')
-    
-elif de == 'e':
-    l.append('echo Encoding...')
-    f1 = file
-    f1 = f1[:-3]
-    f1 = f"{f1}bin"
-    l.append(f'python main2.py encode {file}')
-    l.append(f'python main1.py e {f1}')
-    
-     
-else:
-    print('You stupid idiot?')
-
-
-l.append('color f')
-l.append('cls')
-l.append('echo Done!')
-l.append('pause')
-l.append('cls')
-
-
-
-bat_file_path = 'cache.bat'
-with open(bat_file_path, 'w') as bat_file:
-    for line in l:
-        bat_file.write(line + '\n')
-
-
-os.system(bat_file_path)
-os.remove(bat_file_path)
-
-
-if de == 'd':
-    os.remove(f"{file}.bin")
-
-elif de == 'e':
-    os.remove(f1)
-    
+    print("Example watch: python main.py w <file>")
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    subparsers = parser.add_subparsers(dest='command',
+        help="command (encode/decode/watch)")
+
+    dec_parser = subparsers.add_parser('d')
+    dec_parser.add_argument('file', type=str,
+        help="path to input file(s); accepts wildcard")
+    dec_parser.add_argument('--unicode', action='store_true',
+        help="convert the \\L numeric values to unicode")
+    dec_parser.add_argument('--noasciiconv', action='store_true',
+        help="do not convert the ASCII symbols to decimal values")
+    dec_parser.add_argument('--nolparam', action='store_true',
+        help="remove the L prefix from all command parameter values [experimental]")
+
+    enc_parser = subparsers.add_parser('e')
+    enc_parser.add_argument('file', type=str,
+        help="path to input file(s); accepts wildcard")
+    enc_parser.add_argument('--unicode', action='store_true',
+        help="convert the unicode values back to decimal")
+
+    watch_parser = subparsers.add_parser('w')
+    watch_parser.add_argument('file', type=str,
+        help="path to the readable script file(s) to encode when they're saved; accepts wildcard")
+    watch_parser.add_argument('--unicode', action='store_true',
+        help="convert the unicode values back to decimal")
+    watch_parser.add_argument('--interval', type=float, default=0.1,
+        help="seconds between checking the files (default: %(default)s)")
+    watch_parser.add_argument('--debounce', type=float, default=0.2,
+        help="seconds a file must stay unchanged before it's encoded (default: %(default)s)")
+
+    for p in (dec_parser, enc_parser):
+        p.add_argument('-j', '--jobs', type=int, default=1,
+            help="number of worker processes; 0 for one per CPU")
+        p.add_argument('--incremental', action='store_true',
+            help="skip the files that didn't change since they were last converted")
+        p.add_argument('--manifest', type=str, default=manifest.MANIFEST_FILE,
+            help="manifest file for --incremental (default: %(default)s)")
+        p.add_argument('--timings', action='store_true',
+            help="print the time spent in each conversion stage, per file and in total")
+        p.add_argument('--trace', type=str,
+            help="save the stage timings to this JSON file")
+        p.add_argument('--profile', type=str,
+            help="save a cProfile dump of the conversions to this file; runs without --jobs")
+
+    args = parser.parse_args()
+
+    if args.command in ('d', 'e'):
+        paths = glob.glob(args.file)
+
+        if not paths:
+            raise FileNotFoundError(
+                'no such file %s' % repr(args.file))
+
+        options = {'unicode': args.unicode}
+        if args.command == 'd':
+            print('Decoding...')
+            options.update(noasciiconv=args.noasciiconv, nolparam=args.nolparam)
+        else:
+            print('Encoding...')
+
+        paths = [p for p in paths if not os.path.isdir(p)]
+
+        # Skip the files that didn't change since the last conversion
+        # with the same options, mappings and exceptions
+        if args.incremental:
+            converter = 'main.py %s' % args.command
+            settings = dict(options, mappings=main2.get_mapping_table(
+                main2.MAPPINGS_FILE).digest,
+                exceptions=main2.get_language_exceptions_digest())
+            converters = manifest.load_manifest(args.manifest)
+            paths, unchanged = manifest.split_unchanged(
+                converters, args.manifest, converter, paths, settings)
+            for p in unchanged:
+                print("skipped %s (up to date)" % p)
+
+        report = {} if args.timings or args.trace else None
+        results = batch.run_batch(
+            functools.partial(convert, direction=args.command, **options),
+            paths, 1 if args.profile else args.jobs, report=report)
+
+        failed = 0
+        with timings.profiled(args.profile):
+            for p, out, error in results:
+                if error is not None:
+                    failed += 1
+                    print("error with file %s:\n%s" % (p, error))
+                elif args.incremental:
+                    manifest.record(converters, args.manifest, converter, p,
+                        out, settings)
+
+        if args.incremental:
+            manifest.save_manifest(args.manifest, converters)
+
+        if args.timings:
+            timings.print_report(report)
+        if args.trace:
+            timings.save_report(report, args.trace)
+
+        print('Done!')
+        sys.exit(batch.summarize(failed, len(paths)))
+    elif args.command == 'w':
+        try:
+            watch(args.file, args.unicode, args.interval, args.debounce)
+        except KeyboardInterrupt:
+            print('Done!')
+    else:
+        parser.print_help()
@@ -1,9 +1,15 @@
 import argparse
+import functools
 import glob
 import json
 import os.path
-import shutil
-import traceback
+import struct
+import sys
+
+import batch
+import manifest
+import mapped
+import timings
 
 
 DESCRIPTION = """Encode and decode GS456 (AJ:AA Trilogy) script files."""
@@ -12,133 +18,136 @@ CLASS_GS4 = (0xdaa48445, 0x5212daa2)
 CLASS_GS56 = (0x83f3f042, 0x0b263156)
 CLASS_NAME = (0xee933aa7, 0x1aa1a4ac)
 
+# magic, resource/userdata/info counts, resource/userdata/data offsets
+USR_HEADER = struct.Struct('<4s3I3Q')
+# magic, version, object count, instance count + 1, userdata count, reserved,
+# instance/data/userdata offsets, object table
+RSZ_HEADER = struct.Struct('<4s5I3QI')
+INSTANCE = struct.Struct('<II') # type id, crc
+U32 = struct.Struct('<I')
+U64 = struct.Struct('<Q')
+
 
-read_int = lambda f, l: int.from_bytes(f.read(l), 'little')
-write_int = lambda f, l, x: f.write(x.to_bytes(l, 'little'))
-read_str = lambda f, l: f.read(l * 2).decode('utf-16le')[:-1]
-write_str = lambda f, x: f.write((x + '\0').encode('utf-16le'))
 round_up = lambda x, l: (x + l - 1) // l * l
 seek_pad = lambda f, l: f.seek(round_up(f.tell(), l))
 
 
-def encode(f):
-    is_gs56 = False
-
-    if f.name.endswith('.json'):
-        is_gs56 = True
-        data = json.load(f)
+def write_str(f, x):
+    # length (with the terminator), utf-16 string, padded to 4
+    f.write(U32.pack(len(x) + 1))
+    f.write((x + '\0').encode('utf-16le'))
+    seek_pad(f, 4)
 
-        try:
-            assert isinstance(data['name'], str)
-            assert isinstance(data['labels'], list)
-            for l in data['labels']:
-                assert isinstance(l, list)
-                assert len(l) == 2
-                assert all(isinstance(x, str) for x in l)
-        except AssertionError as e:
-            raise ValueError("incorrect json structure") from e
-    elif not f.name.endswith('.bin'):
-        raise ValueError(
-            "unknown file extension (must be .bin or .json)")
 
-    of = open(f.name.rsplit('.', 1)[0], 'wb')
+@timings.timed('container encode')
+def encode_usr(of, data):
+    # data is the GS4 script (bytes) or the GS56 labels (dict)
+    is_gs56 = isinstance(data, dict)
 
-    of.write(b'USR\0') # magic
-    for i in range(3): # resource, userdata and info counts
-        write_int(of, 4, 0) 
-    for i in range(3): # resource, userdata and data offsets
-        write_int(of, 8, USRHDR_SIZE)
+    of.write(USR_HEADER.pack(b'USR\0', 0, 0, 0,
+        USRHDR_SIZE, USRHDR_SIZE, USRHDR_SIZE))
     seek_pad(of, 16)
 
-    of.write(b'RSZ\0') # magic
-    write_int(of, 4, 16) # version
-    write_int(of, 4, 1) # object count
     instance_count = len(data['labels']) + 1 if is_gs56 else 1
-    write_int(of, 4, instance_count + 1)
-    write_int(of, 4, 0) # userdata count
-    write_int(of, 4, 0) # reserved
-    write_int(of, 8, 52) # instance offset
     data_offset = round_up(52 + (8 * (instance_count + 1)), 16)
-    write_int(of, 8, data_offset) # data offset
-    write_int(of, 8, data_offset) # userdata offset
-
-    write_int(of, 4, instance_count) # object table
+    of.write(RSZ_HEADER.pack(b'RSZ\0', 16, 1, instance_count + 1, 0, 0,
+        52, data_offset, data_offset, instance_count))
 
-    write_int(of, 8, 0) # null
+    of.write(U64.pack(0)) # null
 
     if is_gs56:
         for i in range(instance_count - 1):
-            write_int(of, 4, CLASS_GS56[0])
-            write_int(of, 4, CLASS_GS56[1])
-        write_int(of, 4, CLASS_NAME[0])
-        write_int(of, 4, CLASS_NAME[1])
+            of.write(INSTANCE.pack(*CLASS_GS56))
+        of.write(INSTANCE.pack(*CLASS_NAME))
     else:
-        write_int(of, 4, CLASS_GS4[0])
-        write_int(of, 4, CLASS_GS4[1])
+        of.write(INSTANCE.pack(*CLASS_GS4))
 
     seek_pad(of, 16)
 
     if is_gs56:
         for l in data['labels']:
-            write_int(of, 4, len(l[0]) + 1)
             write_str(of, l[0])
-            seek_pad(of, 4)
-
-            write_int(of, 4, len(l[1]) + 1)
             write_str(of, l[1])
-            seek_pad(of, 4)
-
-        write_int(of, 4, len(data['name']) + 1)
         write_str(of, data['name'])
-        seek_pad(of, 4)
 
-        write_int(of, 4, instance_count - 1)
-        for i in range(instance_count - 1):
-            write_int(of, 4, i + 1)
+        of.write(struct.pack('<%dI' % instance_count,
+            instance_count - 1, *range(1, instance_count)))
     else:
-        f.seek(0, 2)
-        size = f.tell()
-        f.seek(0)
+        of.write(U32.pack(len(data)))
+        for block in mapped.iter_blocks(data):
+            of.write(block)
 
-        write_int(of, 4, size)
-        shutil.copyfileobj(f, of)
 
-    of.close()
-    f.close()
+@timings.timed('main1 encode')
+def encode(f):
+    if f.name.endswith('.json'):
+        data = json.load(f)
+
+        try:
+            assert isinstance(data['name'], str)
+            assert isinstance(data['labels'], list)
+            for l in data['labels']:
+                assert isinstance(l, list)
+                assert len(l) == 2
+                assert all(isinstance(x, str) for x in l)
+        except AssertionError as e:
+            raise ValueError("incorrect json structure") from e
+    elif f.name.endswith('.bin'):
+        data = mapped.map_file(f)
+    else:
+        raise ValueError(
+            "unknown file extension (must be .bin or .json)")
 
+    out = f.name.rsplit('.', 1)[0]
+    with open(out, 'wb') as of:
+        encode_usr(of, data)
 
-def decode(f):
-    assert f.read(4) == b'USR\0' # magic
-    for i in range(3): # resource, userdata and info counts
-        assert read_int(f, 4) == 0
-    for i in range(3): # resource, userdata and data offsets
-        assert read_int(f, 8) == USRHDR_SIZE
-    seek_pad(f, 16)
-    assert f.tell() == USRHDR_SIZE
-
-    assert f.read(4) == b'RSZ\0' # magic
-    assert read_int(f, 4) == 16 # version
-    assert read_int(f, 4) == 1 # object count
-    instance_count = read_int(f, 4) - 1
-    assert read_int(f, 4) == 0 # userdata count
-    assert read_int(f, 4) == 0 # reserved
-    instance_offset = read_int(f, 8)
-    data_offset = read_int(f, 8)
-    assert read_int(f, 8) == data_offset # userdata offset
-
-    assert read_int(f, 4) == instance_count # object table
-
-    assert f.tell() == USRHDR_SIZE + instance_offset
+    f.close()
+    return out
+
+
+def decode_usr(f):
+    # Returns the GS4 script (memoryview) or the GS56 labels (dict)
+    return decode_usr_buffer(mapped.map_file(f))
+
+
+@timings.timed('container decode',
+    lambda data: 0 if isinstance(data, dict) else len(data))
+def decode_usr_buffer(buf):
+    # buf is any bytes-like object (bytes, mmap, ...); the GS4 script is
+    # returned as a memoryview into it, without copying
+    view = memoryview(buf)
+
+    magic, *counts, res_offset, usr_offset, data_offset = \
+        USR_HEADER.unpack_from(view, 0)
+    assert magic == b'USR\0'
+    assert counts == [0, 0, 0] # resource, userdata and info counts
+    assert res_offset == usr_offset == data_offset == USRHDR_SIZE
+    pos = round_up(USR_HEADER.size, 16)
+    assert pos == USRHDR_SIZE
+
+    (magic, version, object_count, instance_count, userdata_count, reserved,
+        instance_offset, data_offset, userdata_offset, object_table) = \
+        RSZ_HEADER.unpack_from(view, pos)
+    instance_count -= 1
+    assert magic == b'RSZ\0'
+    assert version == 16
+    assert object_count == 1
+    assert userdata_count == 0
+    assert reserved == 0
+    assert userdata_offset == data_offset
+    assert object_table == instance_count
+    pos += RSZ_HEADER.size
+
+    assert pos == USRHDR_SIZE + instance_offset
     assert instance_count != 0
-    assert read_int(f, 8) == 0 # null
+    assert U64.unpack_from(view, pos)[0] == 0 # null
+    pos += U64.size
 
     is_gs56 = False
 
-    for i in range(instance_count):
-        type_id = read_int(f, 4)
-        crc = read_int(f, 4)
-        cls = (type_id, crc)
-
+    for i, cls in enumerate(INSTANCE.iter_unpack(
+            view[pos:pos + INSTANCE.size * instance_count])):
         if cls == CLASS_GS4:
             if instance_count != 1:
                 raise ValueError("gs4 class when >1 instance")
@@ -152,48 +161,65 @@ def decode(f):
             is_gs56 = True
         else:
             raise ValueError("unknown class")
+    pos += INSTANCE.size * instance_count
 
-    seek_pad(f, 16)
-    assert f.tell() == USRHDR_SIZE + data_offset
-
-    out = f.name + ('.json' if is_gs56 else '.bin')
+    pos = round_up(pos, 16)
+    assert pos == USRHDR_SIZE + data_offset
 
     if is_gs56:
+        def unpack_str():
+            nonlocal pos
+            size = U32.unpack_from(view, pos)[0]
+            pos += U32.size
+            text = str(view[pos:pos + size * 2], 'utf-16le')[:-1]
+            pos = round_up(pos + size * 2, 4)
+            return text
+
         data = {'name': None, 'labels': []}
 
         for i in range(instance_count - 1):
-            label_size = read_int(f, 4)
-            label = read_str(f, label_size)
-            seek_pad(f, 4)
+            label = unpack_str()
+            text = unpack_str()
+            data['labels'].append((label, text))
 
-            text_size = read_int(f, 4)
-            text = read_str(f, text_size)
-            seek_pad(f, 4)
+        data['name'] = unpack_str()
 
-            data['labels'].append((label, text))
+        indexes = struct.unpack_from('<%dI' % instance_count, view, pos)
+        assert indexes == (instance_count - 1, *range(1, instance_count))
 
-        name_size = read_int(f, 4)
-        data['name'] = read_str(f, name_size)
-        seek_pad(f, 4)
+        return data
+    else:
+        size = U32.unpack_from(view, pos)[0]
+        data = view[pos + U32.size:]
+        assert size == len(data)
 
-        assert read_int(f, 4) == instance_count - 1
-        for i in range(instance_count - 1):
-            assert read_int(f, 4) == i + 1
+        return data
 
+
+@timings.timed('main1 decode')
+def decode(f):
+    data = decode_usr(f)
+    is_gs56 = isinstance(data, dict)
+
+    out = f.name + ('.json' if is_gs56 else '.bin')
+
+    if is_gs56:
         with open(out, 'w', encoding='utf-8', newline='\n') as of:
             json.dump(data, of, indent=2, ensure_ascii=False)
             of.write('\n')
     else:
-        size = read_int(f, 4)
-        cur = f.tell()
-        f.seek(0, 2)
-        assert size == f.tell() - cur
-        f.seek(cur)
-
         with open(out, 'wb') as of:
-            shutil.copyfileobj(f, of)
+            for block in mapped.iter_blocks(data):
+                of.write(block)
 
     f.close()
+    return out
+
+
+def convert_file(path, command):
+    # Returns the path of the written file
+    with open(path, 'rb') as f:
+        return {'e': encode, 'd': decode}[command](f)
 
 
 if __name__ == '__main__':
@@ -211,24 +237,62 @@ if __name__ == '__main__':
     dec_parser.add_argument('file', type=str,
         help="path to input file(s); accepts wildcard")
 
-    mappings = {'e': encode, 'd': decode}
+    for p in (enc_parser, dec_parser):
+        p.add_argument('-j', '--jobs', type=int, default=1,
+            help="number of worker processes; 0 for one per CPU")
+        p.add_argument('--incremental', action='store_true',
+            help="skip the files that didn't change since they were last converted")
+        p.add_argument('--manifest', type=str, default=manifest.MANIFEST_FILE,
+            help="manifest file for --incremental (default: %(default)s)")
+        p.add_argument('--timings', action='store_true',
+            help="print the time spent in each conversion stage, per file and in total")
+        p.add_argument('--trace', type=str,
+            help="save the stage timings to this JSON file")
+        p.add_argument('--profile', type=str,
+            help="save a cProfile dump of the conversions to this file; runs without --jobs")
+
     args = parser.parse_args()
 
-    if args.command in mappings:
+    if args.command in ('e', 'd'):
         paths = glob.glob(args.file)
 
         if not paths:
             raise FileNotFoundError(
                 'no such file %s' % repr(args.file))
 
-        for p in paths:
-            if os.path.isdir(p):
-                continue
-
-            try:
-                mappings[args.command](open(p, 'rb'))
-            except Exception as e:
-                print("error with file %s:\n%s" % (
-                    p, traceback.format_exc()))
+        paths = [p for p in paths if not os.path.isdir(p)]
+
+        if args.incremental:
+            converter = 'main1.py %s' % args.command
+            converters = manifest.load_manifest(args.manifest)
+            paths, unchanged = manifest.split_unchanged(
+                converters, args.manifest, converter, paths, {})
+            for p in unchanged:
+                print("skipped %s (up to date)" % p)
+
+        report = {} if args.timings or args.trace else None
+        results = batch.run_batch(
+            functools.partial(convert_file, command=args.command),
+            paths, 1 if args.profile else args.jobs, report=report)
+
+        failed = 0
+        with timings.profiled(args.profile):
+            for p, out, error in results:
+                if error is not None:
+                    failed += 1
+                    print("error with file %s:\n%s" % (p, error))
+                elif args.incremental:
+                    manifest.record(converters, args.manifest, converter, p,
+                        out, {})
+
+        if args.incremental:
+            manifest.save_manifest(args.manifest, converters)
+
+        if args.timings:
+            timings.print_report(report)
+        if args.trace:
+            timings.save_report(report, args.trace)
+
+        sys.exit(batch.summarize(failed, len(paths)))
     else:
         parser.print_help()
\ No newline at end of file
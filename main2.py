@@ -1,11 +1,28 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import codecs
+import collections
+import functools
 import glob
+import hashlib
+import itertools
+import json
 import re
 import os
 import sys
-import unicodedata
+import types
+
+import batch
+import manifest
+import mapped
+import script_ir
+import timings
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, classify_runs falls back to a regex
+    numpy = None
 
 
 """
@@ -46,63 +63,283 @@ ajaat-gs4-script.py encode --unicode *.txt
 """
 
 
-def load_mappings(filename, separator):
+def parse_mappings(file, separator):
+    replacement_mapping = {}
+    for line in file:
+        # Skip empty lines and lines starting with '#'
+        if line.strip() == '' or line.strip().startswith('#'):
+            continue
+
+        # Split the line by '=', but only once to separate the numeric sequence from the rest of the line
+        numeric_sequence, remaining_part = line.split('=', 1)
+
+        # Split the remaining part by '|', the opcode flags after the argument number are optional
+        parts = remaining_part.split('|')
+        if len(parts) == 2:
+            replacement_string, argument_info = parts
+            flags = None
+        elif len(parts) == 3:
+            replacement_string, argument_info, flags = parts
+            flags = flags.strip()
+        else:
+            # Skip lines that do not contain one or two '|' signs after the '='
+            continue
+
+        # Add back the separator to the string
+        replacement_string += separator
+
+        # Split the argument_info string to extract the argument number and range
+        argument_range = tuple(map(int, argument_info.strip().split('-')))
+
+        replacement_mapping[numeric_sequence.strip()] = (replacement_string.strip(), argument_range, flags)
+    return replacement_mapping
+
+
+def get_mappings_path(filename):
     # Get the directory path of the script
     script_dir = os.path.dirname(os.path.abspath(__file__))
 
     # Construct the full path to the mappings file
-    mappings_file_path = os.path.join(script_dir, filename)
+    return os.path.join(script_dir, filename)
+
+
+def mappings_not_found(filename):
+    print(f"Error: Mapping file '{filename}' not found.")
+    print("Download it from this URL and place it into the script's directory:")
+    print("https://raw.githubusercontent.com/niltwill/capcom-mods/main/scripts/ajaat-gs4-script-mappings.txt")
+    sys.exit(1)
+
+
+def exceptions_not_found(filename):
+    print(f"Error: Exceptions file '{filename}' not found.")
+    print("It comes with the scripts, place it into the script's directory.")
+    sys.exit(1)
+
+
+# Compiled mapping table (read-only), with these indexes:
+# forward: numeric sequence -> (command name, argument range)
+# reverse: command name -> numeric sequence
+# ranges: numeric sequence -> argument range
+# opcodes: command name -> OpcodeDescriptor
+# digest: hash of the mappings file it was compiled from
+MappingTable = collections.namedtuple("MappingTable", ["forward", "reverse", "ranges", "opcodes", "digest"])
+
+# Everything the parameter conversions do differently for a command:
+# other_arguments: the other parameter numbers it can have, "ranges=" flag (used if the line has that many more parameters)
+# conversion: ASCII conversion of the parameters (ascii_convert_command or ascii_convert_prevalues)
+# keep_l_prefix: don't remove the "L" prefix from its "\L<number>|" parameters
+# l_prefix_fix: the number of leading "\L<number>|" parameters to remove the "L" from
+# l_prefix_check: the same, but only if the line has exactly this many parameters
+# skip_ascii_symbols: don't convert the ASCII symbols of its parameters
+# repeat_fix: convert the last of the repeated digits in its parameters (not the first)
+OpcodeDescriptor = collections.namedtuple("OpcodeDescriptor", [
+    "number", "other_arguments", "conversion", "keep_l_prefix", "l_prefix_fix", "l_prefix_check", "skip_ascii_symbols", "repeat_fix"])
+
+# The descriptor of the commands without any flags
+NO_OPCODE_FLAGS = OpcodeDescriptor(None, frozenset(), None, False, 0, 0, False, False)
+
+# The opcode flags of the commands, if the mappings file doesn't have them (older mappings files)
+# Format (space separated): ranges=<n>,<n>... convert=command|prevalues keep-l fix-l=<n> check-l=<n> no-ascii repeat-fix
+DEFAULT_OPCODE_FLAGS = {
+    "\\57347|": "keep-l fix-l=1",  # \color
+    "\\57349|": "ranges=3 convert=command keep-l fix-l=2",  # \music
+    "\\57350|": "keep-l fix-l=2",  # \sound
+    "\\57355|": "keep-l fix-l=1",  # \speed
+    "\\57356|": "keep-l fix-l=1",  # \wait
+    "\\57362|": "keep-l fix-l=1",  # \bgcolor
+    "\\57363|": "keep-l fix-l=1",  # \showphoto
+    "\\57369|": "convert=command repeat-fix",  # \cmd024
+    "\\57370|": "convert=command no-ascii",  # \swoosh
+    "\\57374|": "convert=command keep-l check-l=3",  # \person
+    "\\57378|": "keep-l fix-l=1",  # \fademusic
+    "\\57383|": "keep-l fix-l=2",  # \shake
+    "\\57397|": "ranges=1,2,3,4",  # \cmd051
+    "\\57402|": "convert=prevalues",  # \cmd055
+    "\\57404|": "keep-l fix-l=1",  # \cmd057
+    "\\57416|": "ranges=1,2",  # \cmd066
+    "\\57424|": "ranges=3 convert=prevalues",  # \cmd073
+    "\\57449|": "convert=command",  # \bganim
+    "\\57451|": "ranges=3 convert=prevalues",  # \cmd095
+    "\\57461|": "ranges=4 convert=prevalues",  # \cmd104
+    "\\57462|": "convert=command keep-l fix-l=2 no-ascii",  # \person_face
+    "\\57470|": "keep-l fix-l=1",  # \cmd108
+    "\\57471|": "keep-l fix-l=1",  # \cmd109
+    "\\57489|": "ranges=2 keep-l fix-l=1",  # \codeblock
+    "\\57490|": "ranges=1",  # \cmd123
+}
+
+# Compiled tables of this process, by mappings file name (it's always looked up next to the script)
+mapping_tables = {}
+
+MAPPINGS_CACHE_SUFFIX = ".cache"
+MAPPINGS_CACHE_VERSION = 2
+
+
+def parse_opcode_flags(number, flags):
+    descriptor = NO_OPCODE_FLAGS._replace(number=number)
+    for flag in flags.split():
+        name, _, value = flag.partition('=')
+        try:
+            if name == "ranges":
+                descriptor = descriptor._replace(other_arguments=frozenset(int(n) for n in value.split(',')))
+            elif name == "convert":
+                descriptor = descriptor._replace(conversion=CONVERSION_FUNCTIONS[value])
+            elif name == "keep-l":
+                descriptor = descriptor._replace(keep_l_prefix=True)
+            elif name == "fix-l":
+                descriptor = descriptor._replace(l_prefix_fix=int(value))
+            elif name == "check-l":
+                descriptor = descriptor._replace(l_prefix_check=int(value))
+            elif name == "no-ascii":
+                descriptor = descriptor._replace(skip_ascii_symbols=True)
+            elif name == "repeat-fix":
+                descriptor = descriptor._replace(repeat_fix=True)
+            else:
+                raise KeyError(name)
+        except (KeyError, ValueError):
+            print(f"Error: Invalid opcode flag '{flag}' for command {number} in the mappings file.")
+            sys.exit(1)
+    return descriptor
 
-    replacement_mapping = {}
+
+def compile_mapping_table(replacement_mapping, digest):
+    forward = {key: (value[0], tuple(value[1])) for key, value in replacement_mapping.items()}
+    reverse = {value[0]: key for key, value in forward.items()}
+    ranges = {key: value[1] for key, value in forward.items()}
+    opcodes = {}
+    for key, (name, _, flags) in replacement_mapping.items():
+        if flags is None:
+            flags = DEFAULT_OPCODE_FLAGS.get(key, "")
+        opcodes[name] = parse_opcode_flags(key, flags)
+    return MappingTable(types.MappingProxyType(forward), types.MappingProxyType(reverse),
+                        types.MappingProxyType(ranges), types.MappingProxyType(opcodes), digest)
+
+
+# The on-disk cache is keyed by the mtime and the hash of the mappings file:
+# the mtime is checked first, and the hash only when the mtime has changed
+def read_mappings_cache(cache_path):
     try:
-        with open(mappings_file_path, 'r') as file:
-            for line in file:
-                # Skip empty lines and lines starting with '#'
-                if line.strip() == '' or line.strip().startswith('#'):
-                    continue
-
-                # Split the line by '=', but only once to separate the numeric sequence from the rest of the line
-                numeric_sequence, remaining_part = line.split('=', 1)
-
-                # Split the remaining part by '|'
-                parts = remaining_part.split('|')
-                if len(parts) != 2:
-                    # Skip lines that do not contain exactly one '|' sign after the '='
-                    continue
-
-                replacement_string, argument_info = parts
-                
-                # Add back the separator to the string
-                replacement_string += separator
+        with open(cache_path, 'r', encoding='utf-8') as file:
+            cache = json.load(file)
+        if cache["version"] != MAPPINGS_CACHE_VERSION:
+            return None
+        replacement_mapping = {key: (name, tuple(argument_range), flags) for key, name, argument_range, flags in cache["mappings"]}
+        return cache["mtime"], cache["digest"], replacement_mapping
+    except (OSError, ValueError, KeyError, TypeError):
+        # Missing or broken cache, parse the mappings file again
+        return None
+
+
+def write_mappings_cache(cache_path, mtime, digest, replacement_mapping):
+    cache = {
+        "version": MAPPINGS_CACHE_VERSION,
+        "mtime": mtime,
+        "digest": digest,
+        "mappings": [[key, value[0], list(value[1]), value[2]] for key, value in replacement_mapping.items()],
+    }
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(cache, file)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # The cache is optional (e.g. read-only script directory)
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+def load_mapping_table(filename):
+    mappings_file_path = get_mappings_path(filename)
+    cache_path = mappings_file_path + MAPPINGS_CACHE_SUFFIX
 
-                # Split the argument_info string to extract the argument number and range
-                argument_range = tuple(map(int, argument_info.strip().split('-')))
+    try:
+        mtime = os.stat(mappings_file_path).st_mtime_ns
+    except FileNotFoundError:
+        mappings_not_found(filename)
+
+    cache = read_mappings_cache(cache_path)
+    if cache is not None and cache[0] == mtime:
+        return compile_mapping_table(cache[2], cache[1])
 
-                replacement_mapping[numeric_sequence.strip()] = (replacement_string.strip(), argument_range)
+    try:
+        with open(mappings_file_path, 'rb') as file:
+            data = file.read()
     except FileNotFoundError:
-        print(f"Error: Mapping file '{filename}' not found.")
-        print("Download it from this URL and place it into the script's directory:")
-        print("https://raw.githubusercontent.com/niltwill/capcom-mods/main/scripts/ajaat-gs4-script-mappings.txt")
-        sys.exit(1)
+        mappings_not_found(filename)
+    digest = hashlib.sha256(data).hexdigest()
 
-    return replacement_mapping
+    if cache is not None and cache[1] == digest:
+        # Only the mtime changed (e.g. the file was copied), keep the parsed mappings
+        replacement_mapping = cache[2]
+    else:
+        replacement_mapping = parse_mappings(data.decode().splitlines(), '|')
 
+    write_mappings_cache(cache_path, mtime, digest, replacement_mapping)
+    return compile_mapping_table(replacement_mapping, digest)
 
-# Preprocess mappings to have a static reverse mapping dictionary
-reverse_mapping = {}
 
+# Get the compiled mapping table, the mappings file is only parsed once per process
+def get_mapping_table(filename):
+    table = mapping_tables.get(filename)
+    if table is None:
+        table = mapping_tables[filename] = load_mapping_table(filename)
+    return table
 
+
+# Load the mappings and the language exceptions before converting (e.g. once in every worker process),
+# so the first file doesn't pay for it
 def preprocess_mappings(mappings_file, delimiter='|'):
-    global reverse_mapping
-    replacement_mapping = load_mappings(mappings_file, delimiter)
-    reverse_mapping = {value[0]: key for key, value in replacement_mapping.items()}
+    get_mapping_table(mappings_file)
+    get_language_exceptions()
+
 
+# Function to return the opcode descriptor of a command (with no flags for unknown ones)
+def get_opcode_descriptor(command_name, mappings_file):
+    return get_mapping_table(mappings_file).opcodes.get(command_name, NO_OPCODE_FLAGS)
 
-# Function to return the command number based on the text string
-def get_command_number(command_name):
-    global reverse_mapping
-    if reverse_mapping is not None:
-        return reverse_mapping.get(command_name)
+
+# Language-specific exceptions of the parameter conversions, for the lines the conversions get wrong
+# The file has the exceptions of every conversion stage by language: {stage: {language: {ascii_part: result}}}
+# and they're all loaded into one dictionary, keyed by (stage, ascii_part)
+# (the stages: "ref_symbols", "command", "prevalues", "aftervalues")
+EXCEPTIONS_FILE = "ajaat-gs4-script-exceptions.json"
+EXCEPTIONS_VERSION = 1
+
+language_exceptions = None
+
+
+def load_language_exceptions(filename=EXCEPTIONS_FILE):
+    try:
+        with open(get_mappings_path(filename), 'r', encoding='utf-8') as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        exceptions_not_found(filename)
+
+    if data.get("version") != EXCEPTIONS_VERSION:
+        print(f"Error: Unsupported version of the exceptions file '{filename}'.")
+        sys.exit(1)
+
+    exceptions = {}
+    for stage, languages in data["exceptions"].items():
+        for language, stage_exceptions in languages.items():
+            for ascii_part, result in stage_exceptions.items():
+                exceptions[stage, ascii_part] = result
+    return exceptions
+
+
+def get_language_exceptions():
+    global language_exceptions
+    if language_exceptions is None:
+        language_exceptions = load_language_exceptions()
+    return language_exceptions
+
+
+# Hash of the loaded exceptions (for the incremental conversion settings)
+def get_language_exceptions_digest():
+    exceptions = sorted(get_language_exceptions().items())
+    return hashlib.sha256(json.dumps(exceptions).encode('utf-8')).hexdigest()
 
 
 # Function to convert the decimal ASCII to symbol representation
@@ -140,9 +377,28 @@ def get_first_numeric_values(string, num_parameters):
         return None
 
 
+# The regular expressions of the parameter conversions, compiled once instead of looked up on every call
+# (they run for every command of every line)
+L_NUMBER_PATTERN = re.compile(r"\\L(\d+)")  # \L<number>
+L_NUMBER_OPEN_PATTERN = re.compile(r"\\L(\d+)(?!\|)")  # \L<number> without the "|" delimiter
+L_NUMBER_DELIMITED_PATTERN = re.compile(r"\\L(\d+)\|")  # \L<number>|
+L_NUMBER_BEFORE_COMMAND_PATTERN = re.compile(r"\\L(\d+)\|\\L?")  # \L<number>| followed by another \ or \L
+L_NUMBER_AT_END_PATTERN = re.compile(r"\\L(\d+)\|$")  # \L<number>| at the end
+NUMBER_PATTERN = re.compile(r"\\L?(\d+)")  # \<number> or \L<number>
+NUMBER_DELIMITED_PATTERN = re.compile(r"\\L?(\d+)\|")  # \<number>| or \L<number>|
+NUMBER_OPTIONAL_DELIMITER_PATTERN = re.compile(r"\\L?(\d+)\|?")  # \<number> or \L<number>, with or without "|"
+NUMBER_AND_REST_PATTERN = re.compile(r"\\L?(\d+).*")  # \<number> or \L<number> and the text after it
+TEXT_BEFORE_NUMBER_PATTERN = re.compile(r".{2,}(\d+)")  # The text before a number
+REPEATED_DIGIT_PATTERN = re.compile(r"(?<!\\)(\d)(?:\W|\||\d)*\1")  # A digit that repeats after other digits or delimiters
+BACKSLASH_PATTERN = re.compile(r"\\")
+FIRST_LINE_TEXT_PATTERN = re.compile(r'(?<=\|)([^\\\\]*)')  # The text before \number (first line)
+FIRST_LINE_NUMBER_PATTERN = re.compile(r'\\(\d+)([^|]*)')  # \number and the text after it (first line)
+HEX_ANNOTATION_PATTERN = re.compile(r"\[U\+([0-9a-fA-F]{4})\]")  # [U+<hex>]
+
+
 def find_and_add_delimiters(string):
     # Find all occurrences of "\L[numeric]" or digits not followed by a pipe
-    matches = re.findall(r"\\L(\d+)(?!\|)", string)
+    matches = L_NUMBER_OPEN_PATTERN.findall(string)
 
     # Add delimiters after each match
     for match in matches:
@@ -168,59 +424,26 @@ def replace_all_occurrences_backwards(string, expression, replacement, count=Non
 
 
 def get_range_parameter(replacement_string, ascii_part, num_parameters, mappings_file):
-    # Get command numeric value
-    test_cmd = get_command_number(replacement_string)
+    # Get the other parameter numbers of the command
+    ranges = get_opcode_descriptor(replacement_string, mappings_file).other_arguments
 
     # Really barebones command range support here
     # Cause I didn't want to make this super complicated
     # As there are not that many commands with a range
-    current_cmds = ascii_part.count('\\')
-    base_param = current_cmds - num_parameters
-
-    if test_cmd == "\\57349|":  # \music
-        if base_param == 3:
-            num_parameters = 3
-    elif test_cmd == "\\57397|":  # \cmd051
-        if base_param == 1:
-            num_parameters = 1
-        elif base_param == 2:
-            num_parameters = 2
-        elif base_param == 3:
-            num_parameters = 3
-        elif base_param == 4:
-            num_parameters = 4
-    elif test_cmd == "\\57416|":  # \cmd066
-        if base_param == 1:
-            num_parameters = 1
-        elif base_param == 2:
-            num_parameters = 2
-    elif test_cmd == "\\57424|":  # \cmd073
-        if base_param == 3:
-            num_parameters = 3
-    elif test_cmd == "\\57451|":  # \cmd095
-        if base_param == 3:
-            num_parameters = 3
-    elif test_cmd == "\\57461|":  # \cmd104
-        if base_param == 4:
-            num_parameters = 4
-    elif test_cmd == "\\57489|":  # \codeblock
-        if base_param == 2:
-            num_parameters = 2
-    elif test_cmd == "\\57490|":  # \cmd123
-        if base_param == 1:
-            num_parameters = 1
+    if ranges:
+        num_parameters = script_ir.pick_argument_number(ascii_part.count('\\'), num_parameters, ranges)
 
     return num_parameters
 
 
 def remove_l_prefix(replacement_string, ascii_part, num_parameters, mappings_file, asciiconv):
     num_parameters = get_range_parameter(replacement_string, ascii_part, num_parameters, mappings_file)
-    test_cmd = get_command_number(replacement_string)
+    descriptor = get_opcode_descriptor(replacement_string, mappings_file)
 
     def remove_first_x(regex, text, x):
         result = text
         count = x
-        for match in re.finditer(regex, text):
+        for match in regex.finditer(text):
             if count != 0:
                 count -= 1
                 result = result.replace(match.group(0), "\\" + match.group(1) + "|\\")
@@ -229,41 +452,34 @@ def remove_l_prefix(replacement_string, ascii_part, num_parameters, mappings_fil
     def remove_first_x2(regex, text, x):
         result = text
         count = x
-        for match in re.finditer(regex, text):
+        for match in regex.finditer(text):
             if count != 0:
                 count -= 1
                 result = result.replace(match.group(0), "\\" + match.group(1) + "|")
         return result
 
     # Match only the "\L[numeric]" values
-    regex_numonly = r"\\L(\d+)\|\\L?"
-    regex_numonly2 = r"\\L(\d+)\|$"
-    regex_numonly3 = r"\\L(\d+)\|"
-    regex_numonly4 = r"\\L?(\d+)\|"
-
-    # Remove L letter from string
-    if not test_cmd in {"\\57489|", "\\57355|", "\\57356|", "\\57362|", "\\57383|", "\\57471|",
-    "\\57350|", "\\57374|", "\\57347|", "\\57349|", "\\57363|", "\\57462|", "\\57378|", "\\57404|", "\\57470|"}:
-        # not \codeblock, \speed, \wait, \bgcolor, \shake, \cmd109, \sound, \person, \music, \showphoto, \person_face, \fademusic, \cmd057, \cmd108
+    regex_numonly = L_NUMBER_BEFORE_COMMAND_PATTERN
+    regex_numonly2 = L_NUMBER_AT_END_PATTERN
+    regex_numonly3 = L_NUMBER_DELIMITED_PATTERN
+    regex_numonly4 = NUMBER_DELIMITED_PATTERN
+
+    # Remove L letter from string (not for the commands with keep-l)
+    if not descriptor.keep_l_prefix:
         removed_text = remove_first_x(regex_numonly, ascii_part, num_parameters)
         removed_text2 = remove_first_x2(regex_numonly2, removed_text, num_parameters)
     else:
         removed_text2 = ascii_part
 
-    # Fix some commands that wouldn't work right
+    # Fix some commands that wouldn't work right (fix-l and check-l)
     # TODO (lines like...):
     # \music|\16|dピアノがヘタなパパがいるし。 - ending.user.2.ja.txt
-    if test_cmd in {"\\57489|", "\\57355|", "\\57356|", "\\57362|", "\\57471|", "\\57347|", "\\57363|",  "\\57378|", "\\57404|", "\\57470|"}:
-        # \codeblock, \speed, \wait, \bgcolor, \cmd109, \color, \showphoto, \fademusic, \cmd057, \cmd108
-        if removed_text2.startswith("\\L"):
-            temp_text = remove_first_x2(regex_numonly3, removed_text2, 1)
-            removed_text2 = temp_text
-    elif test_cmd in {"\\57383|", "\\57350|", "\\57349|",  "\\57462|"}:  # \shake, \sound, \music, \person_face
+    if descriptor.l_prefix_fix:
         if removed_text2.startswith("\\L"):
-            temp_text = remove_first_x2(regex_numonly3, removed_text2, 2)
+            temp_text = remove_first_x2(regex_numonly3, removed_text2, descriptor.l_prefix_fix)
             removed_text2 = temp_text
-    elif test_cmd in {"\\57374|"}:  # \person
-        num_param = 3
+    elif descriptor.l_prefix_check:
+        num_param = descriptor.l_prefix_check
         split_cmd = removed_text2.split("|", num_param)
         if len(split_cmd) > 2:
             analyze_string = "\\" + split_cmd[0] + "|" + "\\" + split_cmd[1] + "|" + "\\" + split_cmd[2] + "|"
@@ -291,51 +507,29 @@ def remove_l_prefix(replacement_string, ascii_part, num_parameters, mappings_fil
 
 
 # Function to convert certain ASCII symbols to their decimals (32-126)
+@timings.timed("ascii symbols", len)
 def convert_ascii_symbols(replacement_string, ascii_part, num_parameters, mappings_file):
     # Remove the "|" delimiter
     command_name = replacement_string[:-1]
 
-    # Get command numeric value (to prevent hardcoded texts)
-    test_cmd = get_command_number(replacement_string)
+    # Get the opcode flags of the command (to prevent hardcoded texts)
+    descriptor = get_opcode_descriptor(replacement_string, mappings_file)
 
-    # Do not process these commands as they don't work with this function well
-    if test_cmd in {"\\57370|", "\\57462|"}:  # \swoosh, \person_face
+    # Do not process these commands as they don't work with this function well (no-ascii)
+    if descriptor.skip_ascii_symbols:
         return replacement_string + ascii_part
 
     # Do not process if it contains {REF...}
     # And also convert the exceptions here (otherwise return as is)
     if "{REF " in ascii_part:
-        if ascii_part == r'{REF 2} ':
-            return replacement_string + r'{REF 2}\32|'
-        elif ascii_part == r'{REF 1}3\1|':
-            return replacement_string + r'{REF 1}\51|\1|'
-        elif ascii_part == r'\4|%{REF 7}$':
-            return replacement_string + r'\4|\37|{REF 7}\36|'
-        elif ascii_part == r'\5|T{REF 8}S':
-            return replacement_string + r'\5|\84|{REF 8}\83|'
-        elif ascii_part == r'\5|L{REF 9}K':
-            return replacement_string + r'\5|\76|{REF 9}\75|'
-        elif ascii_part == r'{REF 1}c':
-            return replacement_string + r'{REF 1}\99|'
-        elif ascii_part == r'{REF 10}e':
-            return replacement_string + r'{REF 10}\101|'
-        elif ascii_part == r'{REF 2}1':
-            return replacement_string + r'{REF 2}\49|'
-        elif ascii_part == r'{REF 7}3\1|':
-            return replacement_string + r'{REF 7}\51|\1|'
-        elif ascii_part == r'{REF 1},':
-            return replacement_string + r'{REF 1}\44|'
-        elif ascii_part == r'{REF 1}e':
-            return replacement_string + r'{REF 1}\101|'
-        else:
-            return replacement_string + ascii_part
+        return replacement_string + get_language_exceptions().get(("ref_symbols", ascii_part), ascii_part)
 
     # Get number of parameters for any range command
     current_cmds = ascii_part.count('\\', 0)
     num_parameters = get_range_parameter(replacement_string, ascii_part, num_parameters, mappings_file)
 
     # Match only the "\L[numeric]" values
-    regex_numonly = r"\\L?(\d+)\|?"
+    regex_numonly = NUMBER_OPTIONAL_DELIMITER_PATTERN
     
     # Used to build the string to return
     final_string = ""
@@ -354,7 +548,7 @@ def convert_ascii_symbols(replacement_string, ascii_part, num_parameters, mappin
 
     if current_cmds < num_parameters:
         # Find all matches with their starting and ending positions
-        matches = [match.span() for match in re.finditer(regex_numonly, ascii_part)]
+        matches = [match.span() for match in regex_numonly.finditer(ascii_part)]
         characters = []
 
         i = 0  # Index for the string
@@ -471,10 +665,9 @@ def convert_ascii_symbols(replacement_string, ascii_part, num_parameters, mappin
                     converted = convert_ascii_to_decimal(str(c))
 
                     # Fix replacing the wrong (first) element if duplicate numbers exist
-                    # - Only for this command where it causes issues -
-                    if test_cmd == "\\57369|":  # \cmd024
-                        match_number_repetitions = r"(?<!\\)(\d)(?:\W|\||\d)*\1"
-                        match_nums = re.search(match_number_repetitions, converted_text)
+                    # - Only for the commands where it causes issues (repeat-fix) -
+                    if descriptor.repeat_fix:
+                        match_nums = REPEATED_DIGIT_PATTERN.search(converted_text)
                         if match_nums:
                             value = match_nums.group()
                             if "|" in value and "|\\" not in value: # Make sure to only do this if the repetition is in a different part, not same value
@@ -537,8 +730,7 @@ def convert_ascii_symbols(replacement_string, ascii_part, num_parameters, mappin
 
 def count_backslashes_with_numbers(text, num_parameters):
     count = 0
-    pattern = r"\\L?(\d+)"
-    matches = re.findall(pattern, text)
+    matches = NUMBER_PATTERN.findall(text)
     for match in matches:
         if count < num_parameters:
             count += 1
@@ -547,8 +739,7 @@ def count_backslashes_with_numbers(text, num_parameters):
 
 def replace_single_backslashes(text, num_parameters):
     result = ""
-    pattern = r"\\L?(\d+)"
-    matches = re.finditer(pattern, text)
+    matches = NUMBER_PATTERN.finditer(text)
     ignore_indices = set()
     for match in matches:
         if num_parameters != 0:
@@ -563,7 +754,7 @@ def replace_single_backslashes(text, num_parameters):
             num_parameters -= 1
         ignore_indices.add(start_index)
 
-    filtered_matches = re.finditer(r"\\", text)
+    filtered_matches = BACKSLASH_PATTERN.finditer(text)
     for match in filtered_matches:
         if match.start() not in ignore_indices:
           start = match.start()
@@ -583,22 +774,10 @@ def ascii_convert_command(ascii_part, num_parameters):
     cmd_count = ascii_part.count('\\', 0)
     iteration = num_parameters - cmd_count
 
-    # Exceptional cases that require manual handling
-    #if ascii_part == "\\0|0":
-    #    return "\\0|\\48"
-    if ascii_part == r'\0|\\0|':
-        return r'\0|\92|\0|'
-
-    # For {REF} stuff (\person, \bganim, \swoosh)
-    # -en-
-    if ascii_part == r'\5|{REF 14}VU':
-        return r'\5|{REF 14}\86|\85|'
-    # -de-
-    if ascii_part == r'{REF 8}b\L275|':
-        return r'{REF 8}\98|\L275|'
-    # -fr-
-    elif ascii_part == r'\0|{REF 6}\L4096|%\L817|':
-        return r'\0|{REF 6}\L4096|\37|\L817|'
+    # Exceptional cases that require manual handling (also for {REF} stuff: \person, \bganim, \swoosh)
+    exception = get_language_exceptions().get(("command", ascii_part))
+    if exception is not None:
+        return exception
 
     # Do not process if it still contains {REF...}
     if "{REF " in ascii_part:
@@ -714,10 +893,10 @@ def ascii_convert_prevalues(ascii_part, num):
     cmd_count = ascii_part.count('\\', 0)
     cmd_left = num - cmd_count
 
-    # Return language-specific exceptions here (add your own ones if needed)
-    # -de-
-    if ascii_part == r'\6|\0|\0|\0|h\L228|tte er so stehen m\L252|ssen,':
-        return r'\6|\0|\0|\0|h\L228|tte er so stehen m\L252|ssen,'
+    # Return language-specific exceptions here (add your own ones to the exceptions file if needed)
+    exception = get_language_exceptions().get(("prevalues", ascii_part))
+    if exception is not None:
+        return exception
 
     # Convert two or triple pipes before splitting
     if "|||" in ascii_part:
@@ -733,12 +912,12 @@ def ascii_convert_prevalues(ascii_part, num):
     remaining_string = []
     #converted_num = cmd_count
     converted_num = 0
-    split_pattern = r".{2,}(\d+)" # Match only the values before numbers
+    split_pattern = TEXT_BEFORE_NUMBER_PATTERN # Match only the values before numbers
     string_split = ascii_part.split('|')
     firstOnly = False
     if converted_num <= 4: # Maximum parameter number for all the commands involved
         for text in string_split:
-            match = re.search(split_pattern, text)
+            match = split_pattern.search(text)
             if match:
                 string = match.group()
                 length = len(string)
@@ -794,10 +973,10 @@ def ascii_convert_aftervalues(ascii_part, num):
     if ascii_part.endswith('|'):
         return ascii_part
 
-    # Return language-specific exceptions here (add your own ones if needed)
-    # -ko-
-    if ascii_part == r'\5|\84|\36|\L47560|\L52840|\L45236| \L46300|\L47084|\L45212| \L46319|\L54633|\L45768|\L45796|.':
-        return ascii_part
+    # Return language-specific exceptions here (add your own ones to the exceptions file if needed)
+    exception = get_language_exceptions().get(("aftervalues", ascii_part))
+    if exception is not None:
+        return exception
 
     # Convert two or triple pipes before splitting
     # (should be redundant as this has happened before earlier, but anyway)
@@ -814,14 +993,14 @@ def ascii_convert_aftervalues(ascii_part, num):
     starting_string = []
     space_text = []
     non_matches = 0
-    split_pattern = r"\\L?(\d+).*" # values after numbers
+    split_pattern = NUMBER_AND_REST_PATTERN # values after numbers
     string_split = ascii_part.split('|')
     for text in string_split:
         # If language text has space, do not convert that
         if " \L" in text:
             space_text.append(text + "|")
 
-        match = re.search(split_pattern, text)
+        match = split_pattern.search(text)
         if not match:
             # Text at the end
             length = len(text)
@@ -863,58 +1042,23 @@ def ascii_convert_aftervalues(ascii_part, num):
     return "".join(starting_string + converted_chars)
 
 
-def is_language_related(char):
-    # Get the general category of the character
-    category = unicodedata.category(char)
-    # Check if the character belongs to a script commonly used in languages
-    if category.startswith('L') is not None:
-        return True
-    else:
-        return False
+# The conversions of the "convert=" opcode flag
+CONVERSION_FUNCTIONS = {
+    "command": ascii_convert_command,
+    "prevalues": ascii_convert_prevalues,
+}
 
 
 def process_replacement(replacement_string, line, start_index, ascii_part, num_parameters, mappings_file):
     modified_line = None
     converted_cmd = None
 
-    # Define a dictionary to map command numbers to conversion functions
-    conversion_functions = {
-        "\\57370|": ascii_convert_command,  # \swoosh
-        "\\57374|": ascii_convert_command,  # \person
-        "\\57462|": ascii_convert_command,  # \person_face
-        "\\57349|": ascii_convert_command,  # \music
-        "\\57449|": ascii_convert_command,  # \bganim
-        "\\57369|": ascii_convert_command,  # \cmd024
-        "\\57451|": ascii_convert_command,  # \cmd095
-        "\\57402|": ascii_convert_prevalues,  # \cmd055
-        "\\57424|": ascii_convert_prevalues,  # \cmd073
-        "\\57451|": ascii_convert_prevalues,  # \cmd095
-        "\\57461|": ascii_convert_prevalues  # \cmd104
-    }
-
-    # Get command numeric value (to prevent hardcoded texts)
-    test_cmd = get_command_number(replacement_string)
+    # Get the conversion function of the command (to prevent hardcoded texts)
+    conversion = get_opcode_descriptor(replacement_string, mappings_file).conversion
 
     # Perform the conversions
-    if test_cmd in conversion_functions:
-        converted_cmd = conversion_functions[test_cmd](ascii_part, num_parameters)
-
-    # Apply the conversion if any
-    if converted_cmd is not None:
-        modified_line = replacement_string + converted_cmd
-        ascii_part = converted_cmd  # Update ascii_part with converted_cmd
-
-    # Clear dictionary
-    conversion_functions.clear()
-
-    # Add functions to do after (second phase)
-    conversion_functions = {
-        "\\57397|": ascii_convert_aftervalues,  # \cmd051
-        "\\57402|": ascii_convert_aftervalues,  # \cmd055
-        "\\57416|": ascii_convert_aftervalues,  # \cmd066
-        "\\57424|": ascii_convert_aftervalues,  # \cmd073
-        "\\57451|": ascii_convert_aftervalues  # \cmd095
-    }
+    if conversion is not None:
+        converted_cmd = conversion(ascii_part, num_parameters)
 
     # Apply the conversion if any
     if converted_cmd is not None:
@@ -924,267 +1068,339 @@ def process_replacement(replacement_string, line, start_index, ascii_part, num_p
     return modified_line, ascii_part
 
 
-# Binary search for position (for markers)
-def is_position_in_list(byte_position, position_list):
-    left = 0
-    right = len(position_list) - 1
-
-    while left <= right:
-        mid = (left + right) // 2
-        if position_list[mid] == byte_position:
-            return True
-        elif position_list[mid] < byte_position:
-            left = mid + 1
-        else:
-            right = mid - 1
-
-    return False
-
-
-# For decoding the GS4 scripts
-def decode_gs4_script(input_file, output_file, sections_zero, sections_one, mappings_file, asciiconv=False, lparam=False):
-  with open(input_file, "rb") as f_in, open(output_file, "w") as f_out:
-    data = f_in.read()
+# Printable ASCII characters (without the control characters 0-31, 127)
+ASCII_RUN_PATTERN = re.compile(r"[\x20-\x7e]+")
+
+# Classes of the runs (besides the character classes, script_ir.CHAR_*)
+RUN_ASCII = 3  # Printable ASCII, copied as it is
+RUN_MIXED = 4  # Characters of any class but printable ASCII, classified one by one
+
+# Class of every BMP character for classify_runs, as a NumPy array with the printable ASCII as RUN_ASCII
+# (built on first use)
+run_class_array = None
+
+
+def get_run_class_array():
+    global run_class_array
+    if run_class_array is None:
+        run_class_array = numpy.frombuffer(script_ir.get_char_class_table(), dtype=numpy.uint8).copy()
+        run_class_array[0x20:0x7f] = RUN_ASCII
+    return run_class_array
+
+
+# Split the text into runs of characters of the same class
+# Returns (start, end, run class) tuples covering the whole text
+# With NumPy every character is classified (the UTF-16 code units looked up in the class table),
+# without it the runs are only printable ASCII or RUN_MIXED
+def classify_runs(text):
+    if not text:
+        return []
+
+    if numpy is not None:
+        data = text.encode("utf-16-le", errors="surrogatepass")
+        if len(data) == len(text) * 2:  # One code unit per character (no characters outside the BMP)
+            classes = get_run_class_array()[numpy.frombuffer(data, dtype="<u2")]
+            boundaries = (numpy.flatnonzero(classes[1:] != classes[:-1]) + 1).tolist()
+            starts = [0] + boundaries
+            ends = boundaries + [len(text)]
+            return list(zip(starts, ends, classes[starts].tolist()))
+
+    runs = []
+    position = 0
+    for match in ASCII_RUN_PATTERN.finditer(text):
+        start, end = match.span()
+        if start > position:
+            runs.append((position, start, RUN_MIXED))
+        runs.append((start, end, RUN_ASCII))
+        position = end
+    if position < len(text):
+        runs.append((position, len(text), RUN_MIXED))
+    return runs
+
+
+# Split the text chunks into runs of characters of the same class (classify_runs)
+# Yields (start index, run, run class), the indexes go on across the chunks
+def iter_runs(chunks):
+    chunk_start = 0
+    for chunk in chunks:
+        for start, end, run_class in classify_runs(chunk):
+            yield chunk_start + start, chunk[start:end], run_class
+        chunk_start += len(chunk)
+
+
+# Split the runs further at the marker positions, so the markers only ever come at the start of a run
+def split_runs_at_markers(runs, markers):
+    marker_positions = iter([index for index, _ in markers])
+    next_marker = next(marker_positions, None)
+    for start, run, run_class in runs:
+        end = start + len(run)
+        while next_marker is not None and next_marker < end:
+            if next_marker > start:
+                yield start, run[:next_marker - start], run_class
+                run = run[next_marker - start:]
+                start = next_marker
+            next_marker = next(marker_positions, None)
+        yield start, run, run_class
+
+
+# Run the ASCII symbol conversions on a single command line
+# (The line starts with the mapped command name, followed by its parameters and the text)
+@timings.timed("command parameters", len)
+def process_command_line(line, replacement_string, argument_range, mappings_file, asciiconv=False, lparam=False):
+    start_index = 0
+    while True:
+        start_index = line.find(replacement_string, start_index)
+        if start_index == -1:
+            break
+        ascii_part = (line[start_index + len(replacement_string):])
+        line = replacement_string + ascii_part
+        num_parameters = argument_range[0]
+
+        if not asciiconv:
+            # Process the line with ASCII symbol conversion (through two methods)
+            converted_line = convert_ascii_symbols(replacement_string, ascii_part, num_parameters, mappings_file)
+            if converted_line:
+                line = converted_line
+                ascii_part = (converted_line[start_index + len(replacement_string):])
+
+            # Additional commands to convert from ASCII symbols to decimals
+            modified_line, ascii_part = process_replacement(replacement_string, line, start_index, ascii_part, num_parameters, mappings_file)
+            if modified_line is not None:
+                line = modified_line
+                ascii_part = (modified_line[start_index + len(replacement_string):])
+
+        # Remove "L" prefix from parameter numbers
+        if lparam:
+            line = remove_l_prefix(replacement_string, ascii_part, num_parameters, mappings_file, asciiconv)
+
+        start_index += len(replacement_string)
+    return line
+
+
+# Size of the chunks the scripts are read and decoded in
+DECODE_CHUNK_SIZE = 1 << 16
+
+
+# Slice a bytes-like object (bytes, memoryview, mmap) in chunks, without copying
+# (the pages of a mapped file are released chunk by chunk, see mapped.iter_blocks)
+def iter_buffer_blocks(data, chunk_size=DECODE_CHUNK_SIZE):
+    return mapped.iter_blocks(data, chunk_size)
+
+
+# Decode UTF-16LE from the binary chunks (a surrogate pair or byte split between two chunks is kept for the next one)
+@timings.timed_generator("utf-16 decode", len)
+def iter_utf16_chunks(blocks):
+    # Attempt decoding with UTF-16LE (utf-16le) - alternative might be ISO-8859-1 (latin-1)
+    decoder = codecs.getincrementaldecoder("utf-16le")(errors="replace")
+    for block in blocks:
+        text = decoder.decode(block)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+# Convert the decoded UTF-16 text chunks into the readable format in a single pass
+# Yields the output lines (without the line breaks) as soon as they are finished
+# (first_section and first_ref are the numbers of the first markers, for decoding a part of a script)
+@timings.timed_generator("decode loop", len)
+def decode_gs4_lines(chunks, sections_zero, sections_one, mappings_file, asciiconv=False, lparam=False, first_section=1, first_ref=1):
+    # Get the compiled mappings and the character classes
+    replacement_mapping = get_mapping_table(mappings_file).forward
+    char_classes = script_ir.get_char_class_table()
+
+    # Read ahead until the last possible marker, only the markers inside the text are used
+    chunks = iter(chunks)
+    buffered = []
+    buffered_length = 0
+    last_marker = max(sections_zero + sections_one, default=0) // 2
+    for chunk in chunks:
+        buffered.append(chunk)
+        buffered_length += len(chunk)
+        if buffered_length > last_marker:
+            break
 
-    try:
-      # Attempt decoding with UTF-16LE (utf-16le) - alternative might be ISO-8859-1 (latin-1)
-      text = data.decode("utf-16le", errors="replace")
-    except UnicodeDecodeError:
-      print("Warning: Decoding failed with the UTF-16LE encoding.")
-      sys.exit(1)
-
-    output_lines = []
-    no_conv_lines = []
-    byte_position = 0  # Initialize byte position to be able to find and mark sections
-    section_num = 1  # Initialize section counter
-    section2_num = 1 # Initialize section 2 counter
-    for char in text:
-
-      # If we are at a section marker, insert that here
-      if is_position_in_list(byte_position, sections_zero):
-        output_lines.append("\n\n{SECTION " + str(section_num) + "}\n")
-        section_num += 1
-      if is_position_in_list(byte_position, sections_one):
-        output_lines.append("{REF " + str(section2_num) + "}")
-        section2_num += 1
-
-      # Check if character is within the basic ASCII range without control characters (0-31, 127)
-      if 32 <= ord(char) <= 126:
-        output_lines.append(char)
-      elif unicodedata.category(char)[0] == 'C':
-        #output_lines.append("\\x{:02o}||".format(ord(char))) # convert control characters to octal values
-        #output_lines.append("\\x{:02x}||".format(ord(char))) # convert control characters to hexadecimal values
-        string = "{:d}||".format(ord(char))
-        if (string.startswith("5") or string.startswith("6")) and len(string) >= 7:
-            if section_num == 1:
-                output_lines.append("\\{:d}|".format(ord(char))) # convert control characters to decimal values
-            else:
-                output_lines.append("\n\\{:d}|".format(ord(char))) # add newline for the command control characters
+    # The markers are walked with a cursor alongside the text
+    markers = script_ir.merge_markers(sections_zero, sections_one, buffered_length)
+    markers.append((sys.maxsize, None))  # Sentinel, never reached
+    marker_index = 0
+    next_marker = markers[0][0]
+
+    # Commands only get their own line (and their mapped name) after the first section,
+    # but if the script has no sections at all, the names are used everywhere
+    has_sections = any(kind == 0 for _, kind in markers)
+
+    line = []  # Parts of the current line
+    line_mapping = None  # Mapping of the command the current line starts with
+    section_num = first_section  # Initialize section counter
+    section2_num = first_ref # Initialize section 2 counter
+    for start, run, run_class in split_runs_at_markers(iter_runs(itertools.chain(buffered, chunks)), markers):
+
+      # If we are at a section marker, insert that here (sections come before references)
+      while start == next_marker:
+        if markers[marker_index][1] == 0:
+          yield finish_line(line, line_mapping, mappings_file, asciiconv, lparam)
+          yield ""
+          yield "{SECTION " + str(section_num) + "}"
+          line = []
+          line_mapping = None
+          section_num += 1
         else:
-            output_lines.append("\\{:d}|".format(ord(char))) # convert control characters to decimal values
-      else:
-        # Convert non-ASCII characters to their decimal representations
-        # Otherwise use hex (with the Unicode code point)
-        if is_language_related(char):
-            try:
-                dec_char = ord(char)
-                output_lines.append(f"\\L{dec_char}|")
-            except:
-                hex_char = hex(ord(char))[2:].zfill(2)
-                output_lines.append(f"[U+{hex_char}]")
+          line.append("{REF " + str(section2_num) + "}")
+          section2_num += 1
+        marker_index += 1
+        next_marker = markers[marker_index][0]
+
+      # The basic ASCII characters are copied as they are, the whole run at once
+      if run_class == RUN_ASCII:
+        line.append(run)
+        continue
+
+      # The runs of language and other characters are converted to their decimal values at once too
+      # (the language characters are never ASCII, so the unicode conversion table gives their "\L<number>|" values)
+      if run_class == script_ir.CHAR_LANGUAGE:
+        line.append(run.translate(decimal_table))
+        continue
+      if run_class == script_ir.CHAR_OTHER:
+        line.append("\\" + "|\\".join(map(str, map(ord, run))) + "|")
+        continue
+
+      for char in run:
+        code = ord(char)
+        char_class = char_classes[code] if code < 0x10000 else script_ir.get_char_class(char)
+        if char_class == script_ir.CHAR_CONTROL:
+          string = "\\{:d}|".format(code) # convert control characters to decimal values
+
+          # Start a new line for the command control characters
+          new_line = script_ir.is_line_start(code, char_class) and section_num != 1
+          if new_line:
+            yield finish_line(line, line_mapping, mappings_file, asciiconv, lparam)
+            line = []
+            line_mapping = None
+
+          mapping = replacement_mapping.get(string)
+          if mapping is not None and (section_num != 1 or not has_sections):
+            if new_line:
+              line_mapping = mapping
+            string = mapping[0]
+          line.append(string)
         else:
-            try:
-                dec_char = ord(char)
-                output_lines.append(f"\\{dec_char}|")
-            except:
-                hex_char = hex(ord(char))[2:].zfill(2)
-                output_lines.append(f"[U+{hex_char}]")
-
-      byte_position += 2  # Each character is 2 bytes in UTF-16LE
-
-    # Load mappings from the mappings file
-    replacement_mapping = load_mappings(mappings_file, '|')
-
-    # Apply replacements
-    for numeric_sequence, (replacement_string, argument_range) in replacement_mapping.items():
-        #output_string = "".join(output_lines)
-        #output_string = output_string.replace(numeric_sequence, replacement_string)
-
-        # Split the list based on first "{SECTION 1}"
-        split_index = None
-        for i, element in enumerate(output_lines):
-            if "{SECTION 1}" in element:
-                split_index = i
-                break
-
-        if split_index is not None:
-          lines_before = output_lines[:split_index]
-          lines_after = output_lines[split_index:]
-          before_string = "".join(lines_before)
-          after_string = "".join(lines_after).replace(numeric_sequence, replacement_string)
-          output_string = before_string + after_string
-        else:
-          # Handle the case where "{SECTION 1}" is not found
-          output_string = "".join(output_lines).replace(numeric_sequence, replacement_string)
-
-        if argument_range:
-            lines = output_string.split("\n")
-            for i, line in enumerate(lines):
-                if i == len(lines) - 1 and not line.strip():
-                    break
-                start_index = 0
-                while True:
-                    start_index = line.find(replacement_string, start_index)
-                    if start_index == -1:
-                        break
-                    if section_num == 1:
-                        break
-                    ascii_part = (line[start_index + len(replacement_string):])
-                    line = replacement_string + ascii_part
-                    num_parameters = argument_range[0]
+          # Convert non-ASCII characters to their decimal representations
+          if char_class == script_ir.CHAR_LANGUAGE:
+              line.append(f"\\L{code}|")
+          else:
+              line.append(f"\\{code}|")
 
-                    if not asciiconv:
-                        # Process the line with ASCII symbol conversion (through two methods)
-                        converted_line = convert_ascii_symbols(replacement_string, ascii_part, num_parameters, mappings_file)
-                        if converted_line:
-                            line = converted_line
-                            ascii_part = (converted_line[start_index + len(replacement_string):])
+    yield finish_line(line, line_mapping, mappings_file, asciiconv, lparam)
 
-                        # Additional commands to convert from ASCII symbols to decimals
-                        modified_line, ascii_part = process_replacement(replacement_string, line, start_index, ascii_part, num_parameters, mappings_file)
-                        if modified_line is not None:
-                            line = modified_line
-                            ascii_part = (modified_line[start_index + len(replacement_string):])
 
-                    # Remove "L" prefix from parameter numbers
-                    if lparam:
-                        line = remove_l_prefix(replacement_string, ascii_part, num_parameters, mappings_file, asciiconv)
+# Join the parts of a finished line, and convert the command parameters if it starts with a command
+def finish_line(line, mapping, mappings_file, asciiconv=False, lparam=False):
+    line = "".join(line)
+    if mapping is not None:
+        replacement_string, argument_range = mapping
+        line = process_command_line(line, replacement_string, argument_range, mappings_file, asciiconv, lparam)
+    return line
 
-                    start_index += len(replacement_string)
-                lines[i] = line
-            output_string = '\n'.join(lines)
-        output_lines = output_string.splitlines(keepends=True)
 
-    # Write the converted text with annotations to the output file
-    f_out.write("".join(output_lines))
+# Also convert the ASCII symbols to decimals on first line
+@timings.timed("first line fix", len)
+def fix_first_line_text(text):
+    # Handle the first line, remove the "L" chars and convert ASCII symbols here too
+    first_line_end = text.find("\n") + 1 or len(text)
+    first_line = text[:first_line_end]
+
+    # Split the line in case of extra newlines
+    lines = first_line.splitlines()
+
+    # The line is needed with at least two characters (the first byte is checked below)
+    if not lines or len(lines[0]) < 2:
+        print("Can't read first line of the script")
+        sys.exit(1)
 
+    # Remove the "L" from first line, as that's needed for the regex to work
+    modified_line = L_NUMBER_PATTERN.sub(r'\\\1', lines[0])
+
+    # Manually catch and convert any "\\" sign (regex is not going to find this)
+    if "\\\\" in modified_line:
+        changed_line = modified_line
+        changed_line = changed_line.replace('\\\\', '\\92|\\')
+        modified_line = changed_line
+
+    # Find all matches for the text before \number in the string
+    matches_before = FIRST_LINE_TEXT_PATTERN.finditer(modified_line)
+
+    # Find all matches for \number and the text after it in the string
+    matches_after = FIRST_LINE_NUMBER_PATTERN.finditer(modified_line)
+
+    # Empty string to hold the values
+    final_line = ""
+
+    # Manually add the very first byte if the second byte starts with "\"
+    # (As the regex fails to catch this one)
+    second_byte = modified_line[1]
+    if second_byte == '\\':
+        first_byte = modified_line[0]
+        replaced_char = convert_ascii_to_decimal(first_byte)
+        final_line += "\\" + str(replaced_char) + "|"
+
+    # Extract captured groups from matches
+    for match_before, match_after in zip(matches_before, matches_after):
+        text_before = match_before.group(1)  # Capture the text before \number
+        # Capture the numeric value (\number)
+        number = match_after.group(1)
+        # Capture the text after \number
+        text_after = match_after.group(2)
+
+        if number:
+            final_line += "\\" + str(number) + "|"
+        if text_before:
+            if not text_before.startswith("{REF "):  # Do not convert {REF...} values
+                for char in text_before:
+                    replaced_char = convert_ascii_to_decimal(char)
+                    final_line += "\\" + str(replaced_char) + "|"
+            else:
+                final_line += text_before
+        if text_after:
+            if not text_before.startswith("{REF "):  # Do not convert {REF...} values
+                for char in text_after:
+                    replaced_char = convert_ascii_to_decimal(char)
+                    final_line += "\\" + str(replaced_char) + "|"
+            else:
+                final_line += text_after
 
-# Also convert the ASCII symbols to decimals on first line
-def fix_first_line(annotated_file, output_file):
-  with open(annotated_file, "r") as f_in, open(output_file, "w") as f_out:
-    try:
-        # Handle the first line, remove the "L" chars and convert ASCII symbols here too
-        first_line = f_in.readline()
-
-        # Split the line in case of extra newlines
-        lines = first_line.splitlines()
-
-        # Remove the "L" from first line, as that's needed for the regex to work
-        modified_line = re.sub(r'\\L(\d+)', r'\\\1', lines[0])
-
-        # Manually catch and convert any "\\" sign (regex is not going to find this)
-        if "\\\\" in modified_line:
-            changed_line = modified_line
-            changed_line = changed_line.replace('\\\\', '\\92|\\')
-            modified_line = changed_line
-
-        # Match two patterns with regex
-        pattern_before = r'(?<=\|)([^\\\\]*)'  # Pattern to capture text before \number
-        pattern_after = r'\\(\d+)([^|]*)'  # Pattern to capture \number and text after it
-
-        # Find all matches for pattern_before in the string
-        matches_before = re.finditer(pattern_before, modified_line)
-
-        # Find all matches for pattern_after in the string
-        matches_after = re.finditer(pattern_after, modified_line)
-
-        # Empty string to hold the values
-        final_line = ""
-
-        # Manually add the very first byte if the second byte starts with "\"
-        # (As the regex fails to catch this one)
-        second_byte = modified_line[1]
-        if second_byte == '\\':
-            first_byte = modified_line[0]
-            replaced_char = convert_ascii_to_decimal(first_byte)
-            final_line += "\\" + str(replaced_char) + "|"
-
-        # Extract captured groups from matches
-        for match_before, match_after in zip(matches_before, matches_after):
-            text_before = match_before.group(1)  # Capture the text before \number
-            # Capture the numeric value (\number)
-            number = match_after.group(1)
-            # Capture the text after \number
-            text_after = match_after.group(2)
-
-            if number:
-                final_line += "\\" + str(number) + "|"
-            if text_before:
-                if not text_before.startswith("{REF "):  # Do not convert {REF...} values
-                    for char in text_before:
-                        replaced_char = convert_ascii_to_decimal(char)
-                        final_line += "\\" + str(replaced_char) + "|"
-                else:
-                    final_line += text_before
-            if text_after:
-                if not text_before.startswith("{REF "):  # Do not convert {REF...} values
-                    for char in text_after:
-                        replaced_char = convert_ascii_to_decimal(char)
-                        final_line += "\\" + str(replaced_char) + "|"
-                else:
-                    final_line += text_after
+    modified_line = final_line
 
-        modified_line = final_line
+    return modified_line + '\n' + text[first_line_end:]
 
-        f_out.write(modified_line + '\n' + f_in.read())
-    except IndexError:
-        print(f"Can't read first line of: {f_in}")
-        sys.exit(1)
-  
 
-def remove_newlines_and_replace_inplace(filename, mappings_file):
-    temp_filename = filename + ".temp"  # Create a temporary filename
+# Every "\\...|" token of the text, command names are found by looking up the whole token
+# (a command name always starts at a "\\" and ends at the first "|")
+COMMAND_TOKEN_PATTERN = re.compile(r"\\[^\\|]*\|")
+SECTION_MARKER_PATTERN = re.compile(r"\{SECTION[^}]*\}")
+REF_MARKER_PATTERN = re.compile(r"\{REF[^}]*\}")
 
-    # Load mappings from the mappings file
-    replacement_mapping = load_mappings(mappings_file, '|')
 
-    # Construct the replacement string pattern using only the replacement strings
-    replacement_strings = [value[0] for value in replacement_mapping.values()]
-    escaped_replacement_strings = [re.escape(string) for string in replacement_strings]
-    #replacement_string_pattern = "|".join(f"{escaped_string}" for escaped_string in escaped_replacement_strings)
-    replacement_string_pattern = "|".join(escaped_replacement_strings)
+# Replace the command names with their numeric sequences, mark the sections and remove newlines
+@timings.timed("command names", len)
+def replace_command_names(content, mappings_file):
+    # Get the compiled mappings
+    reverse = get_mapping_table(mappings_file).reverse
 
     # Define a function to replace replacement strings with their corresponding numeric sequences
     def replace_replacement_string(match):
         matched_string = match.group(0)
-        #return next((key for key, value in replacement_mapping.items() if value[0].rstrip('|') == matched_string), matched_string)
-        return next(key for key, value in replacement_mapping.items() if value[0] == matched_string)
-
-    # Read the original file, apply replacements, and remove newlines
-    with open(filename, 'r') as infile, open(temp_filename, 'w') as outfile:
-        try:
-            content = infile.read()
-            modified_content = re.sub(replacement_string_pattern, replace_replacement_string, content)
-            modified_content_with_sections = re.sub(r"\{SECTION[^}]*\}", "|SECTION|", modified_content)
-            modified_content_with_sections2 = re.sub(r"\{REF[^}]*\}", "|REF|", modified_content_with_sections)
-            modified_content_without_newlines = modified_content_with_sections2.replace('\n', '')
-            outfile.write(modified_content_without_newlines)
-        except UnicodeDecodeError as e:
-            print(f"The '{filename}' cannot be encoded.")
-            print(f"Error message: {e}")
-            sys.exit(1)
-
-    # Replace the original file with the temporary file (atomic operation)
-    os.replace(temp_filename, filename)
+        return reverse.get(matched_string, matched_string)
 
+    modified_content = COMMAND_TOKEN_PATTERN.sub(replace_replacement_string, content)
+    modified_content_with_sections = SECTION_MARKER_PATTERN.sub("|SECTION|", modified_content)
+    modified_content_with_sections2 = REF_MARKER_PATTERN.sub("|REF|", modified_content_with_sections)
+    return modified_content_with_sections2.replace('\n', '')
 
-def encode_gs4_script(input_file, output_file, target_encoding="utf-16le"):
-  with open(input_file, "r") as f_in, open(output_file, "wb") as f_out:
-    text = f_in.read()
 
-    # Define a regular expression to match control characters
-    #controlchar_pattern = r"\\x([0-9a-fA-F]{2,4})\|"
-    controlchar_pattern = r"\\L?(\d+)\|"
+@timings.timed("utf-16 encode", len)
+def encode_gs4_text(text, target_encoding="utf-16le"):
 
     def replace_decimal(match):
       decimal_value = int(match.group(1))
@@ -1196,9 +1412,6 @@ def encode_gs4_script(input_file, output_file, target_encoding="utf-16le"):
         hex_code = format(decimal_value, '04X')
         return f"[U+{hex_code}]"
 
-    # Define a regular expression to match hex annotations (within square brackets)
-    hex_pattern = r"\[U\+([0-9a-fA-F]{4})\]"
-
     def replace_hex(match):
       # Extract the hex code from the match object (group 1)
       hex_code = match.group(1)
@@ -1211,220 +1424,381 @@ def encode_gs4_script(input_file, output_file, target_encoding="utf-16le"):
           return "?"
 
     # Replace annotations with their corresponding characters
-    text_without_dec = re.sub(controlchar_pattern, replace_decimal, text)
-    text_without_hex = re.sub(hex_pattern, replace_hex, text_without_dec)
+    # (control characters, then the hex annotations within square brackets)
+    text_without_dec = NUMBER_DELIMITED_PATTERN.sub(replace_decimal, text)
+    text_without_hex = HEX_ANNOTATION_PATTERN.sub(replace_hex, text_without_dec)
 
     try:
       # Encode the text without hex annotations back to the target encoding
-      encoded_data = text_without_hex.encode(target_encoding)
+      return text_without_hex.encode(target_encoding)
     except UnicodeEncodeError:
       print(f"Error: Encoding back to {target_encoding} failed. Consider a different encoding.")
-      return
-
-    # Write to output file
-    f_out.write(encoded_data)
-
-
-# Split sections by 0 (main) and 1 (sub)
-def split_list_by_following_element(input_list):
-    list_0 = []
-    list_1 = []
-    for i in range(len(input_list) - 1):  # Iterate until the second last element
-        current_element = input_list[i]
-        next_element = input_list[i + 1]
-        if next_element == 0:
-            list_0.append(current_element)
-        elif next_element == 1:
-            list_1.append(current_element)
-    return list_0, list_1
-
-
-# Extract position values for decoding
-def extract_position_values(filename):
-    positions = []
-    first_value = None  # Initialize a variable to store the first value
-    sections_read = 0   # Initialize a variable for sections
-    with open(filename, 'rb') as file:
-        chunk_size = 1024  # As the files are small, this should be enough
-        offset = 0  # Start from beginning of the file
-        chunk = file.read(chunk_size)  # Read the first chunk
-        while chunk:  # Continue until no more data is read
-            if offset == 0:  # Check if it's the first chunk
-                # Read two bytes and convert to UInt16 for the first value
-                first_value = int.from_bytes(chunk[:2], byteorder='little')
-                chunk = chunk[2:]  # Move chunk pointer forward
-                offset += 2  # Increment offset by the number of bytes read
-            else:
-                # Iterate over the remaining chunk by 2 bytes (UInt16)
-                for i in range(0, len(chunk), 2):
-                    # Read two bytes and convert to UInt16
-                    uint16_value = int.from_bytes(chunk[i:i+2], byteorder='little')
-                    if sections_read != (first_value * 2) + 1:
-                        positions.append(uint16_value)  # Append number to list
-                        sections_read += 1
-                # Read the next chunk
-                chunk = file.read(chunk_size)
-                offset += len(chunk)  # Increment offset by the number of bytes read
+      return None
+
+
+# Section markers in the encoded script (UTF-16LE)
+SECTION_MARKER_BYTES = "|SECTION|".encode("utf-16le")
+REF_MARKER_BYTES = "|REF|".encode("utf-16le")
+MARKER_BYTES_PATTERN = re.compile(re.escape(SECTION_MARKER_BYTES) + b"|" + re.escape(REF_MARKER_BYTES))
+
+
+# Remove the |SECTION| and |REF| markers in one scan
+# The offsets are the marker positions in the data without any markers
+def strip_section_markers(data):
+    parts = []
+    sections = []
+    refs = []
+    removed = 0
+    last_end = 0
+    for match in MARKER_BYTES_PATTERN.finditer(data):
+        start, end = match.span()
+        parts.append(data[last_end:start])
+        if match.group() == SECTION_MARKER_BYTES:
+            sections.append(start - removed)
+        else:
+            refs.append(start - removed)
+        removed += end - start
+        last_end = end
+    parts.append(data[last_end:])
+    return b"".join(parts), sections, refs
 
-    if positions[0] == 0:  # Remove zero value if that's the first element
-        temp_list = positions[1:]
-        positions = temp_list
 
-    list_0, list_1 = split_list_by_following_element(positions)
-    return list_0, list_1
+# Build the final binary: new position offsets table followed by the script body
+@timings.timed("offset table build", len)
+def build_gs4_binary(data):
+    body, sections, refs = strip_section_markers(data)
 
+    # Skip the old offsets table (first line of the text)
+    if body:
+        body = body[body[0] * 4 + 4:]
 
-def remove_bytes(binary_file, position, bytes_to_remove):
-    # Open the binary file in read and write mode
-    with open(binary_file, "r+b") as f:
-        # Move the file pointer to the position of the bytes to be removed
-        f.seek(position)
+    # Sections with 0 (main) values come first, then the ones with 1 (sub)
+    for offset in itertools.chain(sections, refs):
+        if offset > 0xFFFF:
+            raise ValueError(f"Marker at byte {offset} is past the 16-bit offsets of the offset table")
+    table = script_ir.words_to_bytes(script_ir.make_table(sections, refs))
 
-        # Read the bytes at the specified position
-        bytes_read = f.read(len(bytes_to_remove))
+    # Read the table back the same way the decoder does
+    if script_ir.read_position_values(table) != (sections, refs):
+        raise ValueError("The offset table doesn't read back as the markers it was built from")
 
-        # Check if the bytes read match the specified bytes to remove
-        if bytes_read == bytes_to_remove:
-            # Save the current position as the offset
-            offset = f.tell()
+    return table + body
 
-            # Move the file pointer back to the position of the bytes to be removed
-            f.seek(position + len(bytes_to_remove))
 
-            # Read the remaining bytes from the file
-            remaining_bytes = f.read()
+# Characters of the "\L<number>|" values, by the number text (filled as they are used)
+class UnicodeTable(dict):
+    def __missing__(self, number):
+        char = self[number] = chr(int(number))
+        return char
 
-            # Move the file pointer back to the position of the bytes to be removed
-            f.seek(position)
 
-            # Write the remaining bytes back to the file
-            f.write(remaining_bytes)
+# str.translate table of the non-ASCII characters to their "\L<number>|" values (filled as they are used)
+class DecimalTable(dict):
+    def __missing__(self, code):
+        value = self[code] = chr(code) if code <= 127 else f"\\L{code}|"
+        return value
 
-            # Truncate the file to remove the extra bytes at the end
-            f.truncate(position + len(remaining_bytes))
 
-            # Return the offset of the bytes found
-            return offset
-        else:
-            # If the bytes read do not match the specified bytes to remove, do nothing
-            return None
+unicode_table = UnicodeTable()
+decimal_table = DecimalTable()
 
 
-# Clean file of initial values
-def remove_initial_values(filename):
-    with open(filename, 'r+b') as file:
-        # Read the first byte separately
-        first_byte = file.read(1)
-
-        if first_byte:
-            # Determine the number of bytes to remove based on the value of the first byte
-            bytes_to_remove = (ord(first_byte) * 4) + 4  # +4 to include the first byte too
-
-            # Move the file pointer to the position after the bytes to remove
-            file.seek(bytes_to_remove)
-
-            # Read the remaining content
-            content = file.read()
-
-            # Move the file pointer to the beginning
-            file.seek(0)
-
-            # Write the remaining content starting from the beginning of the file
-            file.write(content)
-
-            # Truncate the file to remove the remaining content
-            file.truncate()
-
-
-# Get position offsets
-def find_offsets(binary_file, search_string):
-    offsets = []
-    with open(binary_file, 'rb') as file:
-        # Read the entire file as binary data
-        data = file.read()
-        # Initialize the starting index for searching
-        start_index = 0
-        # Loop until there are no more matches
-        while True:
-            # Find the next occurrence of the search string
-            index = data.find(search_string, start_index)
-            if index == -1:
-                break  # No more occurrences found
-            # Add the offset to the list
-            offsets.append(index)
-            # Move the starting index for the next search
-            start_index = index + len(search_string)
-    return offsets
-
-
-def insert_values(filename, values):
-    with open(filename, 'r+b') as file:
-        # Get the total size of bytes to insert
-        total_insert_size = sum(len(value.to_bytes(2, byteorder='little')) for value in values)
-
-        # Read the existing content from the file
-        existing_content = file.read()
-
-        # Move the file pointer to the position after inserted bytes
-        file.seek(total_insert_size)
-
-        # Write back the existing content, effectively shifting it after inserted bytes
-        file.write(existing_content)
-
-        # Move the file pointer back to the beginning of the file
-        file.seek(0)
-
-        # Write the inserted values at the beginning of the file
-        for value in values:
-            file.write(value.to_bytes(2, byteorder='little'))
-
-
-# Create temp file for position offsets: |REF|
-def copy_file(src_file, dst_file):
-    # Open source file for reading and destination file for writing
-    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
-        # Read and write in chunks to avoid loading the entire file into memory
-        chunk_size = 1024  # Should be enough for these small files
-        while True:
-            chunk = src.read(chunk_size)
-            if not chunk:
-                break
-            dst.write(chunk)
+@timings.timed("unicode conversion", len)
+def convert_decimal_to_unicode(text):
+    if "\\L" not in text:
+        return text
 
+    # Every second part is the number of a "\L<number>|" value
+    parts = L_NUMBER_DELIMITED_PATTERN.split(text)
+    parts[1::2] = map(unicode_table.__getitem__, parts[1::2])
+    return "".join(parts)
 
-def rename_decoded_file(output_file):
-  final_name = os.path.splitext(output_file)[0]
-  os.rename(output_file, final_name)
 
+@timings.timed("unicode to decimal", len)
+def convert_to_decimal(text):
+    if text.isascii():
+        return text
 
-def convert_decimal_to_unicode(text):
-    def replace_unicode(match):
-        decimal_code = int(match.group(1))
-        hex_code = hex(decimal_code)[2:]
-        return chr(int(hex_code, 16))
+    # The non-ASCII characters are converted to their decimal representation, the ASCII ones are kept
+    return text.translate(decimal_table)
 
-    unicode_pattern = r"\\L(\d+)\|"
-    result = re.sub(unicode_pattern, replace_unicode, text)
-    return result
 
+# Default mappings text file
+MAPPINGS_FILE = "ajaat-gs4-script-mappings.txt"
 
-def convert_to_decimal(text):
-    result = ''
-    for char in text:
-        if ord(char) > 127:
-            # Character is non-ASCII, convert it to decimal representation
-            decimal_value = ord(char)
-            result += f"\\L{decimal_value}|"
+
+# Convert the decoded UTF-16 text chunks of a GS4 script into the readable format
+# Yields the pieces of the readable script, the first line fix and the unicode conversion are done on the way
+@timings.timed_generator("decode pipeline", len)
+def decode_script_pieces(chunks, sections_zero, sections_one, mappings_file=MAPPINGS_FILE, asciiconv=False, lparam=False, unicode=False):
+    lines = decode_gs4_lines(chunks, sections_zero, sections_one, mappings_file, asciiconv, lparam)
+
+    # Fix the first line (removing the L chars and converting ASCII symbols to decimals), this adds the line break too
+    first_line = next(lines)
+    if not asciiconv:
+        first_line = fix_first_line_text(first_line)
+        separator = ""
+    else:
+        separator = "\n"
+
+    # Decode into unicode with optional flag (line by line, the \L values never span lines)
+    yield convert_decimal_to_unicode(first_line) if unicode else first_line
+    for line in lines:
+        piece = separator + line
+        separator = "\n"
+        yield convert_decimal_to_unicode(piece) if unicode else piece
+
+
+# Decode a GS4 script (the .bin data, any bytes-like object) into the readable format, yields it in pieces
+def iter_decode_script(data, mappings_file=MAPPINGS_FILE, asciiconv=False, lparam=False, unicode=False):
+    preprocess_mappings(mappings_file)
+    sections_zero, sections_one = script_ir.read_position_values(data)
+
+    chunks = iter_utf16_chunks(iter_buffer_blocks(data))
+    yield from decode_script_pieces(chunks, sections_zero, sections_one, mappings_file, asciiconv, lparam, unicode)
+
+
+# Decode a GS4 script (the .bin data) into the readable format
+def decode_script(data, mappings_file=MAPPINGS_FILE, asciiconv=False, lparam=False, unicode=False):
+    return "".join(iter_decode_script(data, mappings_file, asciiconv, lparam, unicode))
+
+
+# The script as opcodes, argument words and text runs (script_ir.Script), without the text format
+# script_ir.assemble() gives the script payload back, byte for byte
+def disassemble_script(data, mappings_file=MAPPINGS_FILE):
+    return script_ir.disassemble(data, get_mapping_table(mappings_file))
+
+
+# Encode a readable GS4 script back to the .bin data (None if it can't be encoded)
+def encode_script(text, mappings_file=MAPPINGS_FILE, unicode=False):
+    preprocess_mappings(mappings_file)
+
+    # Encode unicode back to decimal with optional flag
+    if unicode:
+        text = convert_to_decimal(text)
+
+    encoded_data = encode_gs4_text(replace_command_names(text, mappings_file))
+    if encoded_data is None:
+        return None
+
+    return build_gs4_binary(encoded_data)
+
+
+@timings.timed("read", len)
+def read_script_text(input_file, unicode=False):
+    with open(input_file, "r", encoding="utf-8" if unicode else None) as f_in:
+        return f_in.read()
+
+
+# Write the readable script piece by piece, as it's decoded
+def write_script_pieces(output_file, pieces, unicode=False):
+    if unicode:
+        write_file_atomic(output_file, (piece.encode("utf-8", errors="ignore") for piece in pieces), "wb")
+    else:
+        write_file_atomic(output_file, pieces, "w")
+
+
+# Write the pieces to a temporary file first, which replaces the output file once everything is written
+# (so a failed conversion never leaves a partial output file behind)
+@timings.timed("write")
+def write_file_atomic(output_file, pieces, mode="wb"):
+    temp_file = f"{output_file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, mode) as f_out:
+            for piece in pieces:
+                f_out.write(piece)
+        os.replace(temp_file, output_file)
+    except BaseException:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        raise
+
+
+# Section index of a script (the .idx sidecar next to the .bin file), for decoding single sections:
+# sections: number, char (position in the decoded text), offset and end (bytes in the .bin data),
+#           first_ref and refs (number of the first REF in the section and how many), lines
+# refs: number, char, offset, section (0 before the first section), line
+# The lines ([first, end) for the sections) are only known if the index was written while decoding (--index),
+# otherwise they are None. size and mtime are the ones of the .bin file it was built from.
+SECTION_INDEX_SUFFIX = ".idx"
+SECTION_INDEX_VERSION = 1
+
+MARKER_LINE_PATTERN = re.compile(r"\{(SECTION|REF) (\d+)\}")
+
+
+def get_section_index_path(input_file):
+    return os.path.splitext(input_file)[0] + SECTION_INDEX_SUFFIX
+
+
+# Build the section index from the offset table (the markers are placed the same way as decode_gs4_lines does)
+def build_section_index(data):
+    sections_zero, sections_one = script_ir.read_position_values(data)
+
+    # The markers are 16 bit byte offsets, so only the start of the text is decoded: up to the last marker's
+    # character, which is at most twice as many words in (all of them outside the BMP), and a character more
+    last_char = max(sections_zero + sections_one, default=0) // 2
+    text = str(data[:(last_char + 2) * 4], "utf-16le", "replace")
+
+    # Characters outside the BMP take two UTF-16 words, the byte offsets have to skip them
+    astral_chars = [match.start() for match in script_ir.ASTRAL_CHAR_PATTERN.finditer(text)]
+    def byte_offset(char_index):
+        return script_ir.char_to_word_index(char_index, astral_chars) * 2
+
+    sections = []
+    refs = []
+    for char_index, kind in script_ir.merge_markers(sections_zero, sections_one, len(text)):
+        if kind == 0:
+            if sections:
+                sections[-1]["end"] = byte_offset(char_index)
+            sections.append({"number": len(sections) + 1, "char": char_index, "offset": byte_offset(char_index),
+                             "end": len(data), "first_ref": len(refs) + 1, "refs": 0, "lines": None})
         else:
-            # Character is ASCII, keep it unchanged
-            result += char
-    return result
+            if sections:
+                sections[-1]["refs"] += 1
+            refs.append({"number": len(refs) + 1, "char": char_index, "offset": byte_offset(char_index),
+                         "section": len(sections), "line": None})
+    return {"version": SECTION_INDEX_VERSION, "sections": sections, "refs": refs}
+
+
+# Add the line numbers of the markers, from the lines of the decoded text
+def add_index_lines(index, marker_lines, num_lines):
+    sections = index["sections"]
+    for kind, number, line_number in marker_lines:
+        if kind == "SECTION" and number <= len(sections):
+            sections[number - 1]["lines"] = [line_number, num_lines]
+            if number > 1:
+                # The previous section ends before the empty line
+                sections[number - 2]["lines"][1] = line_number - 1
+        elif kind == "REF" and number <= len(index["refs"]):
+            index["refs"][number - 1]["line"] = line_number
+
+
+# Pass the decoded pieces through, and note the lines of the {SECTION n} and {REF n} markers
+def iter_index_lines(pieces, marker_lines, num_lines):
+    line_number = 0
+    for piece in pieces:
+        for match in MARKER_LINE_PATTERN.finditer(piece):
+            marker_lines.append((match.group(1), int(match.group(2)), line_number + piece.count("\n", 0, match.start())))
+        line_number += piece.count("\n")
+        yield piece
+    num_lines.append(line_number + 1)
+
+
+def save_section_index(index_file, index, input_file):
+    stat = os.stat(input_file)
+    index = dict(index, size=stat.st_size, mtime=stat.st_mtime_ns)
+    write_file_atomic(index_file, [json.dumps(index)], "w")
+
+
+# The section index of a .bin file, from its sidecar if it's up to date, otherwise built (and saved) now
+def load_section_index(input_file, data):
+    index_file = get_section_index_path(input_file)
+    stat = os.stat(input_file)
+    try:
+        with open(index_file, 'r', encoding='utf-8') as file:
+            index = json.load(file)
+        if (index["version"] == SECTION_INDEX_VERSION and index["size"] == stat.st_size
+                and index["mtime"] == stat.st_mtime_ns):
+            return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    index = build_section_index(data)
+    try:
+        save_section_index(index_file, index, input_file)
+    except OSError:
+        pass  # The sidecar is optional (e.g. read-only directory)
+    return index
+
+
+# Decode only some sections of a GS4 script (the .bin data), yields them in pieces like iter_decode_script
+# Only the bytes of these sections are decoded, with the markers and numbers from the section index
+def iter_decode_sections(data, index, numbers, mappings_file=MAPPINGS_FILE, asciiconv=False, lparam=False, unicode=False):
+    preprocess_mappings(mappings_file)
+    sections = index["sections"]
+    for number in numbers:
+        if not 1 <= number <= len(sections):
+            raise ValueError(f"The script has no section {number} (it has {len(sections)})")
+
+    separator = ""
+    for number in numbers:
+        section = sections[number - 1]
+        text = str(data[section["offset"]:section["end"]], "utf-16le", "replace")
+        refs = index["refs"][section["first_ref"] - 1:section["first_ref"] - 1 + section["refs"]]
+        refs_one = [(ref["char"] - section["char"]) * 2 for ref in refs]
+        lines = decode_gs4_lines([text], [0], refs_one, mappings_file, asciiconv, lparam, number, section["first_ref"])
+
+        # Skip the end of the previous line and the empty line before the section
+        next(lines)
+        next(lines)
+        for line in lines:
+            piece = separator + line
+            separator = "\n"
+            yield convert_decimal_to_unicode(piece) if unicode else piece
+        separator = "\n\n"
+
+
+def decode_sections_file(input_file, numbers, output_file=None, mappings_file=MAPPINGS_FILE, unicode=False, asciiconv=False, lparam=False):
+    numbers_text = "-".join(str(number) for number in numbers)
+    output_file = output_file if output_file else f"{os.path.splitext(input_file)[0]}.section{numbers_text}.txt"
+    with open(input_file, "rb") as f_in:
+        data = mapped.map_file(f_in)
+    index = load_section_index(input_file, data)
+
+    pieces = iter_decode_sections(data, index, numbers, mappings_file, asciiconv, lparam, unicode)
+    write_script_pieces(output_file, pieces, unicode)
+
+    return output_file
+
+
+def decode_file(input_file, output_file=None, mappings_file=MAPPINGS_FILE, unicode=False, asciiconv=False, lparam=False, index=False):
+    output_file = output_file if output_file else f"{os.path.splitext(input_file)[0]}.txt"
+    preprocess_mappings(mappings_file)
+
+    # The offset table and the text are read from the mapped file
+    with open(input_file, "rb") as f_in:
+        data = mapped.map_file(f_in)
+    sections_zero, sections_one = script_ir.read_position_values(data)
+
+    # Decode, fix the first line (removing the L chars and converting ASCII symbols to decimals)
+    # and decode into unicode with optional flag, all while streaming to the output file
+    pieces = decode_script_pieces(iter_utf16_chunks(iter_buffer_blocks(data)), sections_zero, sections_one, mappings_file, asciiconv, lparam, unicode)
+
+    # Write the section index too (with the lines of the markers in the output)
+    if index:
+        marker_lines = []
+        num_lines = []
+        pieces = iter_index_lines(pieces, marker_lines, num_lines)
+    write_script_pieces(output_file, pieces, unicode)
+
+    if index:
+        section_index = build_section_index(data)
+        add_index_lines(section_index, marker_lines, num_lines[0])
+        save_section_index(get_section_index_path(input_file), section_index, input_file)
+
+    return output_file
+
+
+def encode_file(input_file, output_file=None, mappings_file=MAPPINGS_FILE, unicode=False):
+    output_file = output_file if output_file else f"{os.path.splitext(input_file)[0]}.bin"
+
+    # Read the script once (it's left as it is), encode unicode back to decimal with optional flag,
+    # replace the command names and write the output file once
+    text = read_script_text(input_file, unicode)
+    data = encode_script(text, mappings_file, unicode)
+    if data is None:
+        raise ValueError(f"Can't encode {input_file}")
+    write_file_atomic(output_file, [data])
+
+    return output_file
 
 
 def main():
     # Define the mappings text file
-    mappings = "ajaat-gs4-script-mappings.txt"
-    # Call preprocess_mappings for command name lookup
+    mappings = MAPPINGS_FILE
+    # Load the mappings once, before the files are converted
     preprocess_mappings(mappings)
 
     # Parse command-line arguments
@@ -1438,6 +1812,8 @@ def main():
     decode_parser.add_argument("--unicode", action="store_true", help="Convert the \L numeric values to unicode (optional)")
     decode_parser.add_argument("--noasciiconv", action="store_true", help="Do not convert the ASCII symbols to decimal values (optional)")
     decode_parser.add_argument("--nolparam", action="store_true", help="Removes the L prefix from all command parameter values [experimental] (optional)")
+    decode_parser.add_argument("--index", action="store_true", help="Also write the section index (.idx) next to the input file (optional)")
+    decode_parser.add_argument("--section", type=int, action="append", metavar="N", help="Decode only this section, can be repeated, the output file defaults to <name>.section<N>.txt (optional)")
 
     # Subparser for encoding
     encode_parser = subparsers.add_parser("encode", help="Encode readable GS4 scripts back to binary")
@@ -1445,6 +1821,14 @@ def main():
     encode_parser.add_argument("output_file", type=str, nargs='?', default=None, help="Path to the output binary file (optional)")
     encode_parser.add_argument("--unicode", action="store_true", help="Convert the unicode values back to decimal (optional)")
 
+    for subparser in (decode_parser, encode_parser):
+        subparser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes, 0 for one per CPU (optional)")
+        subparser.add_argument("--incremental", action="store_true", help="Skip the files that didn't change since they were last converted (optional)")
+        subparser.add_argument("--manifest", type=str, default=manifest.MANIFEST_FILE, help=f"Manifest file for --incremental, default: {manifest.MANIFEST_FILE} (optional)")
+        subparser.add_argument("--timings", action="store_true", help="Print the time spent in each conversion stage, per file and in total (optional)")
+        subparser.add_argument("--trace", type=str, default=None, help="Save the stage timings to this JSON file (optional)")
+        subparser.add_argument("--profile", type=str, default=None, help="Save a cProfile dump of the conversions to this file, runs without --jobs (optional)")
+
     args = parser.parse_args()
 
     # Validate argument usage based on chosen command
@@ -1455,173 +1839,63 @@ def main():
         parser.error("Invalid command. Choose either decode or encode")
 
     # Decode argument
-    if args.command == "decode":
-        input_files = glob.glob(args.input_file)
-        for input_file in input_files:
-            output_file = args.output_file if args.output_file else f"{os.path.splitext(input_file)[0]}.txt"
-            sections_zero, sections_one = extract_position_values(input_file)
-            decode_gs4_script(input_file, output_file, sections_zero, sections_one, mappings, asciiconv=args.noasciiconv, lparam=args.nolparam)
-
-            # Fix the first line of the file (removing the L chars and converting ASCII symbols to decimals)
-            if not args.noasciiconv:
-                fix_first_line(output_file, f"{output_file}.2")
-            else:
-                copy_file(output_file, f"{output_file}.2")
-
-            # Decode into unicode with optional flag
-            if args.unicode:
-                try:
-                    with open(f"{output_file}.2", "r", encoding="utf-8") as f_in:
-                        input_text = f_in.read()
-
-                    output_text = convert_decimal_to_unicode(input_text)
-
-                    with open(f"{output_file}.3", "wb") as f_out:
-                        f_out.write(output_text.encode("utf-8", errors="ignore"))
-                except FileNotFoundError:
-                    print(f"Error: File not found: {output_file}.2")
-                    sys.exit(1)
-                except Exception as e:
-                    print(f"Error processing file {output_file}.2: {str(e)}")
-                    sys.exit(1)
-
-            # Remove temporary output file if it exists
-            try:
-                os.remove(output_file)
-            except FileNotFoundError:
-                pass
-
-            # Rename the final file to the original output file
-            if args.unicode:
-                rename_decoded_file(f"{output_file}.3")
-                try:
-                    os.remove(f"{output_file}.2")
-                except FileNotFoundError:
-                    pass
-            else:
-                rename_decoded_file(f"{output_file}.2")
-
-            # Write conversion message to console
-            print(f'Converted "{input_file}" to readable format: "{output_file}"')
-
+    if args.command == "decode" and args.section:
+        # Only the requested sections, with the section index (built from the offset table if there's none)
+        convert = functools.partial(decode_sections_file, numbers=args.section, output_file=args.output_file, mappings_file=mappings,
+                                    unicode=args.unicode, asciiconv=args.noasciiconv, lparam=args.nolparam)
+        settings = {"unicode": args.unicode, "noasciiconv": args.noasciiconv, "nolparam": args.nolparam, "section": args.section}
+        message = 'Converted sections of "{}" to readable format: "{}"'
+
+    elif args.command == "decode":
+        convert = functools.partial(decode_file, output_file=args.output_file, mappings_file=mappings,
+                                    unicode=args.unicode, asciiconv=args.noasciiconv, lparam=args.nolparam, index=args.index)
+        settings = {"unicode": args.unicode, "noasciiconv": args.noasciiconv, "nolparam": args.nolparam, "index": args.index}
+        message = 'Converted "{}" to readable format: "{}"'
 
     # Encode argument
     elif args.command == "encode":
-        input_files = glob.glob(args.input_file)
-        for input_file in input_files:
-            output_file = args.output_file if args.output_file else f"{os.path.splitext(input_file)[0]}.bin"
-            
-            # Encode unicode back to decimal with optional flag
-            if args.unicode:
-                try:
-                    with open(input_file, "r", encoding="utf-8") as f_in:
-                        input_text = f_in.read()
-
-                    output_text = convert_to_decimal(input_text)
-
-                    with open(f"{input_file}.2", "w", encoding="utf-8") as f_out:
-                        f_out.write(output_text)
-                except FileNotFoundError:
-                    print(f"Error: File not found: {input_file}")
-                    sys.exit(1)
-                except Exception as e:
-                    print(f"Error processing file {input_file}: {str(e)}")
-                    sys.exit(1)
-
-            # Rename the final file to the original output file
-            if args.unicode:
-                try:
-                    os.remove(f"{input_file}")
-                except FileNotFoundError:
-                    pass
-                rename_decoded_file(f"{input_file}.2")
-
-            remove_newlines_and_replace_inplace(input_file, mappings)
-            encode_gs4_script(input_file, output_file)
-
-            # For the position offsets, a temp file is needed due to some offsets having a value of 1, not 0
-            copy_file(output_file, f"{output_file}.TMP")
-            temp_file = f"{output_file}.TMP"
-
-            #
-            # Write the new position offsets
-            #
-            str_sec = 18  # |SECTION| = 18 (9*2)
-            str_ref = 10  # |REF| = 10 (5*2)
-            string_value1 = b'|\x00S\x00E\x00C\x00T\x00I\x00O\x00N\x00|\x00'
-            string_value2 = b'|\x00R\x00E\x00F\x00|\x00'
-            sections = []
-            sections2 = []
-            aligned_sections = []
-            aligned_sections2 = []
-
-            # 1. Calculate the offsets for sections with 1 values in temp file first
-            # Remove |SECTION| strings, leave only |REF|
-            zero_offsets = find_offsets(temp_file, string_value1)
-            if zero_offsets:
-                zero_offsets.sort(reverse=True)
-                for p in zero_offsets:
-                    section_offset = remove_bytes(temp_file, p, string_value1)
-                    zero_offsets = [x - str_sec for x in zero_offsets if x > p]
-                    
-            # Find and store the offsets for the |REF| strings only
-            one_offsets = find_offsets(temp_file, string_value2)
-            if one_offsets:
-                one_offsets.sort(reverse=True)
-                for p in one_offsets:
-                    section_offset2 = remove_bytes(temp_file, p, string_value2)
-                    if section_offset2 is not None:
-                        sections2.append(section_offset2)
-                    one_offsets = [x - str_ref for x in one_offsets if x > p]
-                sections2 = sorted(sections2)
-                aligned_sections2 = [x - (str_ref * i) for i, x in enumerate(sections2, 1)]
-                
-            modified_list2 = [x for pair in zip(aligned_sections2, [1] * len(aligned_sections2)) for x in pair]
-
-            # Discard the temp file, as it's no longer needed
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-
-            # 2. Calculate the offsets for sections with 0 values in original file
-            # Remove |REF| strings, leave only |SECTION|
-            one_offsets = find_offsets(output_file, string_value2)
-            if one_offsets:
-                one_offsets.sort(reverse=True)
-                for p in one_offsets:
-                    section_offset2 = remove_bytes(output_file, p, string_value2)
-                    one_offsets = [x - str_ref for x in one_offsets if x > p]
-
-            # Find and store the offsets for the |SECTION| strings only
-            zero_offsets = find_offsets(output_file, string_value1)
-            if zero_offsets:
-                zero_offsets.sort(reverse=True)
-                for p in zero_offsets:
-                    section_offset = remove_bytes(output_file, p, string_value1)
-                    if section_offset is not None:
-                        sections.append(section_offset)
-                    zero_offsets = [x - str_sec for x in zero_offsets if x > p]
-                sections = sorted(sections)
-                aligned_sections = [x - (str_sec * i) for i, x in enumerate(sections, 1)]
-
-            # Add zeroes and ones back into the lists
-            modified_list1 = [x for pair in zip(aligned_sections, [0] * len(aligned_sections)) for x in pair]
-            modified_lists = modified_list1 + modified_list2
-
-            # Count every section
-            joined_sections = aligned_sections + aligned_sections2
-            position_counter = len(joined_sections)
-
-            # Add the position counter to the list too
-            modified_lists.insert(0, position_counter)
-            modified_lists.insert(1, 0)
-
-            # Insert new position values
-            remove_initial_values(output_file)
-            insert_values(output_file, modified_lists)
-
-            # Write conversion message to console
-            print(f'Converted "{input_file}" back to binary format: "{output_file}"')
+        convert = functools.partial(encode_file, output_file=args.output_file, mappings_file=mappings,
+                                    unicode=args.unicode)
+        settings = {"unicode": args.unicode}
+        message = 'Converted "{}" back to binary format: "{}"'
+
+    input_files = glob.glob(args.input_file)
+
+    # Skip the files that didn't change since the last conversion with the same settings, mappings and exceptions
+    if args.incremental:
+        converter = f"main2.py {args.command}"
+        settings.update(output_file=args.output_file, mappings=get_mapping_table(mappings).digest,
+                        exceptions=get_language_exceptions_digest())
+        converters = manifest.load_manifest(args.manifest)
+        input_files, unchanged = manifest.split_unchanged(converters, args.manifest, converter, input_files, settings)
+        for input_file in unchanged:
+            print(f'Skipped "{input_file}" (up to date)')
+
+    # Convert the files (in worker processes with --jobs), and report the errors at the end
+    failed = 0
+    report = {} if args.timings or args.trace else None
+    jobs = 1 if args.profile else args.jobs
+    with timings.profiled(args.profile):
+        for input_file, output_file, error in batch.run_batch(convert, input_files, jobs, preprocess_mappings, (mappings,), report):
+            if error is not None:
+                failed += 1
+                print(f'Error with file "{input_file}":\n{error}')
+            else:
+                # Write conversion message to console
+                print(message.format(input_file, output_file))
+                if args.incremental:
+                    manifest.record(converters, args.manifest, converter, input_file, output_file, settings)
+
+    if args.incremental:
+        manifest.save_manifest(args.manifest, converters)
+
+    # Stage timings
+    if args.timings:
+        timings.print_report(report)
+    if args.trace:
+        timings.save_report(report, args.trace)
 
+    sys.exit(batch.summarize(failed, len(input_files)))
 
 if __name__ == "__main__":
   main()
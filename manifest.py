@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+
+import mapped
+
+
+# Manifest of the converted files, for the incremental mode (--incremental)
+# For every converter ("main.py d", "main2.py encode", ...) and input file (relative to the manifest)
+# it keeps the settings and the input and output file states they were converted with
+MANIFEST_FILE = ".gs4-manifest.json"
+MANIFEST_VERSION = 1
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("converters", {})
+
+
+def save_manifest(manifest_path, converters):
+    manifest = {"version": MANIFEST_VERSION, "converters": converters}
+    temp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+# Size, modification time and hash of a file (None if it doesn't exist)
+# The hash of the previous state is reused if the size and the modification time didn't change
+def file_state(path, previous=None):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime_ns:
+        return previous
+
+    with open(path, 'rb') as file:
+        digest = hashlib.sha256(mapped.map_file(file)).hexdigest()
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "digest": digest}
+
+
+def same_content(state, previous):
+    return state is not None and previous is not None and state["digest"] == previous["digest"]
+
+
+# The paths are stored relative to the manifest
+def relative_path(manifest_path, path):
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    return os.path.relpath(os.path.abspath(path), manifest_dir).replace(os.sep, '/')
+
+
+def absolute_path(manifest_path, path):
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    return os.path.join(manifest_dir, path.replace('/', os.sep))
+
+
+# Split the input files into the ones to convert and the ones that are up to date
+# (same input content, same settings, and the output is still the one that was written)
+def split_unchanged(converters, manifest_path, converter, paths, settings):
+    entries = converters.get(converter, {})
+    changed = []
+    unchanged = []
+    for path in paths:
+        entry = entries.get(relative_path(manifest_path, path))
+        if (entry is not None and entry["settings"] == settings
+                and same_content(file_state(path, entry["input"]), entry["input"])
+                and same_content(file_state(absolute_path(manifest_path, entry["output_file"]), entry["output"]), entry["output"])):
+            unchanged.append(path)
+        else:
+            changed.append(path)
+    return changed, unchanged
+
+
+# Record a converted file
+def record(converters, manifest_path, converter, input_file, output_file, settings):
+    converters.setdefault(converter, {})[relative_path(manifest_path, input_file)] = {
+        "settings": settings,
+        "input": file_state(input_file),
+        "output_file": relative_path(manifest_path, output_file),
+        "output": file_state(output_file),
+    }
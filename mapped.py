@@ -0,0 +1,34 @@
+import mmap
+import os
+
+
+# Size of the blocks the mapped files are read in
+BLOCK_SIZE = 1 << 16
+
+
+# Map an open binary file read-only, returns a bytes-like object of its contents
+# The pages are read on demand, and nothing is copied into Python bytes
+# (the mapping is released together with the last view into it; empty files can't be mapped and give b'')
+def map_file(f):
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# Slice a bytes-like object (bytes, memoryview, mmap) in blocks, without copying
+# For a mapped file (or a view into one), the pages of every block are released once the next block is asked for,
+# so reading a large file through the mapping only keeps about one block of it in memory
+# (the pages are read from the file again if they're used again; without madvise, e.g. on Windows, nothing is released)
+def iter_blocks(data, block_size=BLOCK_SIZE):
+    view = memoryview(data)
+    mapping = view.obj if isinstance(view.obj, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED") else None
+    released = 0
+    for start in range(0, len(view), block_size):
+        yield view[start:start + block_size]
+        if mapping is not None:
+            # A view starts at or after the start of the mapping, so everything before the block's end in the view
+            # is behind it in the mapping too (madvise wants whole pages)
+            end = (start + block_size) // mmap.PAGESIZE * mmap.PAGESIZE
+            if end > released:
+                mapping.madvise(mmap.MADV_DONTNEED, released, min(end, len(mapping)) - released)
+                released = end
@@ -0,0 +1,343 @@
+import array
+import bisect
+import itertools
+import operator
+import re
+import sys
+import unicodedata
+
+import timings
+
+
+# In-memory representation of a GS4 script payload (the .bin files), without the text format:
+# the offset table, the UTF-16 words of the body, and the body split into records
+# (a command: its opcode and argument words, or a run of text words between the commands)
+# disassemble() and assemble() round trip any payload byte for byte
+OP_TEXT = 0
+OP_COMMAND = 1
+
+# Kinds of the offset table entries
+MARKER_SECTION = 0
+MARKER_REF = 1
+
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+class Script:
+    __slots__ = ("table", "words", "kinds", "starts", "tail")
+
+    # table: array('H') of the offset table (number of entries, 0, then offset and kind of every entry)
+    # words: array('H') of the body after the table
+    # kinds, starts: kind and first word of every record, a record ends where the next one starts
+    # (starts has one more item, the end of the body)
+    # tail: the last byte, if the payload has an odd length
+    def __init__(self, table, words, kinds=None, starts=None, tail=b""):
+        self.table = table
+        self.words = words
+        self.kinds = kinds if kinds is not None else array.array('B')
+        self.starts = starts if starts is not None else array.array('I', [len(words)])
+        self.tail = tail
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __repr__(self):
+        return f"<Script {len(self.kinds)} records, {len(self.words)} words, {len(self.markers())} markers>"
+
+    # (kind, first word, end word) of every record
+    def records(self):
+        starts = self.starts
+        return zip(self.kinds, starts, starts[1:])
+
+    def opcode(self, index):
+        return self.words[self.starts[index]] if self.kinds[index] == OP_COMMAND else None
+
+    def arguments(self, index):
+        start = self.starts[index] + (self.kinds[index] == OP_COMMAND)
+        return self.words[start:self.starts[index + 1]]
+
+    def text(self, index):
+        return words_to_bytes(self.words[self.starts[index]:self.starts[index + 1]]).decode("utf-16le", "surrogatepass")
+
+    # Size of the offset table in bytes, the marker offsets count from the start of the table
+    def table_size(self):
+        return len(self.table) * 2
+
+    # (offset, kind) of every entry of the offset table, in table order
+    def markers(self):
+        table = self.table
+        return [(table[i], table[i + 1]) for i in range(2, len(table) - 1, 2)]
+
+    @property
+    def sections(self):
+        return [offset for offset, kind in self.markers() if kind == MARKER_SECTION]
+
+    @property
+    def refs(self):
+        return [offset for offset, kind in self.markers() if kind == MARKER_REF]
+
+    # Replace the offset table, the offsets don't move the body
+    def set_markers(self, sections, refs):
+        self.table = make_table(sections, refs)
+
+
+def words_to_bytes(words):
+    if LITTLE_ENDIAN:
+        return words.tobytes()
+    swapped = array.array('H', words)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def bytes_to_words(data):
+    words = array.array('H')
+    words.frombytes(data)
+    if not LITTLE_ENDIAN:
+        words.byteswap()
+    return words
+
+
+# Offset table with the sections (0, main) first, then the references (1, sub)
+def make_table(sections, refs):
+    table = array.array('H', [len(sections) + len(refs), 0])
+    for offset in sections:
+        table.extend((offset, MARKER_SECTION))
+    for offset in refs:
+        table.extend((offset, MARKER_REF))
+    return table
+
+
+# Opcode search pattern, argument numbers and the other argument numbers (ranges= opcode flag)
+# of a mapping table (main2.get_mapping_table)
+opcode_patterns = {}
+
+
+def get_opcode_pattern(mapping_table):
+    pattern = opcode_patterns.get(mapping_table.digest)
+    if pattern is None:
+        arguments = {int(key[1:-1]): argument_range[0] for key, argument_range in mapping_table.ranges.items()}
+        ranges = {int(descriptor.number[1:-1]): descriptor.other_arguments
+                  for descriptor in mapping_table.opcodes.values() if descriptor.other_arguments}
+        regex = re.compile("[" + "".join(re.escape(chr(opcode)) for opcode in sorted(arguments)) + "]")
+        pattern = opcode_patterns[mapping_table.digest] = (regex, arguments, ranges)
+    return pattern
+
+
+# The rules of the decoder (main2.decode_gs4_lines) that disassemble() follows too: the offset table,
+# where its markers go in the decoded text, the character classes, where a command starts a line,
+# and which argument number a command with other argument numbers gets
+
+# Split sections by 0 (main) and 1 (sub): every value followed by a 0 or a 1
+# (itertools.compress picks them without a Python call per value)
+def split_list_by_following_element(input_list):
+    list_0 = list(itertools.compress(input_list, map(operator.not_, input_list[1:])))
+    list_1 = list(itertools.compress(input_list, map((1).__eq__, input_list[1:])))
+    return list_0, list_1
+
+
+# Size of the offset table in bytes (without the first value), from its first value
+def offset_table_size(first_value):
+    return ((first_value * 2) + 1) * 2
+
+
+# Extract position values for decoding
+@timings.timed("offset table")
+def read_position_values(data):
+    # The first value is the number of sections, followed by (number * 2) + 1 values
+    first_value = int.from_bytes(data[:2], byteorder='little')
+    table = data[2:2 + offset_table_size(first_value)]
+    positions = bytes_to_words(table[:len(table) & ~1])
+    if len(table) & 1:
+        positions.append(table[-1])  # Cut off in the middle of a value
+
+    if positions[0] == 0:  # Remove zero value if that's the first element
+        positions = positions[1:]
+
+    return split_list_by_following_element(positions)
+
+
+# Binary search for position (for markers)
+def is_position_in_list(byte_position, position_list):
+    left = 0
+    right = len(position_list) - 1
+
+    while left <= right:
+        mid = (left + right) // 2
+        if position_list[mid] == byte_position:
+            return True
+        elif position_list[mid] < byte_position:
+            left = mid + 1
+        else:
+            right = mid - 1
+
+    return False
+
+
+# Merge the section (kind 0) and reference (kind 1) byte offsets into one list of markers,
+# sorted by the character index they are inserted at
+# Only the offsets the binary search finds are kept (so unsorted tables behave as before),
+# odd and out of range offsets never match a character
+# The decoder reads the whole payload (the table too) as UTF-16 text, and a marker goes before the character
+# at half its byte offset, so after a character outside the BMP it's one word further in the payload
+def merge_markers(sections_zero, sections_one, text_length):
+    markers = []
+    for kind, position_list in enumerate((sections_zero, sections_one)):
+        for byte_position in set(position_list):
+            if byte_position % 2 == 0 and 0 <= byte_position < text_length * 2 and is_position_in_list(byte_position, position_list):
+                markers.append((byte_position // 2, kind))
+    markers.sort()
+    return markers
+
+
+# Characters outside the BMP, one character of the decoded text but two UTF-16 words
+ASTRAL_CHAR_PATTERN = re.compile("[\U00010000-\U0010ffff]")
+
+
+# Word index in the payload of a character of its decoded text (astral_chars: the sorted character indexes
+# of the characters outside the BMP)
+def char_to_word_index(char_index, astral_chars):
+    return char_index + bisect.bisect_left(astral_chars, char_index)
+
+
+def is_language_related(char):
+    # Get the general category of the character
+    category = unicodedata.category(char)
+    # Check if the character belongs to a script commonly used in languages
+    if category.startswith('L') is not None:
+        return True
+    else:
+        return False
+
+
+# Character classes for the decoder
+CHAR_OTHER = 0  # Written as \<number>|
+CHAR_CONTROL = 1  # Control characters (and commands), written as \<number>| or the command name
+CHAR_LANGUAGE = 2  # Written as \L<number>|
+
+
+def get_char_class(char):
+    if unicodedata.category(char)[0] == 'C':
+        return CHAR_CONTROL
+    elif is_language_related(char):
+        return CHAR_LANGUAGE
+    else:
+        return CHAR_OTHER
+
+
+# Class of every BMP character, indexed by code point (built on first use)
+char_class_table = None
+
+
+def get_char_class_table():
+    global char_class_table
+    if char_class_table is None:
+        char_class_table = bytes(get_char_class(chr(code)) for code in range(0x10000))
+    return char_class_table
+
+
+# Whether a character starts a new line in the decoded text (after the first section): the control characters
+# whose decimal value has at least 5 digits and starts with 5 or 6 (the commands)
+def is_line_start(code, char_class):
+    return char_class == CHAR_CONTROL and code >= 10000 and str(code)[0] in "56"
+
+
+# Argument number of a command with other argument numbers (ranges= opcode flag), from the number of
+# backslashes in the rest of its decoded line: that number less the argument number, if that's one of the others
+def pick_argument_number(backslashes, number, other_numbers):
+    extra = backslashes - number
+    return extra if extra in other_numbers else number
+
+
+# The characters the decoder writes with a backslash: everything outside printable ASCII, and "\\" itself
+BACKSLASH_CHAR_PATTERN = re.compile(r"[^\x20-\x5b\x5d-\x7e]")
+
+
+# Argument number the decoder gives a command with other argument numbers at a character of the decoded text
+# (its line ends at the next command that starts a line, or at the next section)
+def get_range_arguments(chars, char_index, section_chars, number, other_numbers):
+    section_index = bisect.bisect_right(section_chars, char_index)
+    end = section_chars[section_index] if section_index < len(section_chars) else len(chars)
+    char_classes = get_char_class_table()
+    line_end = char_index + 1
+    while line_end < end:
+        code = ord(chars[line_end])
+        char_class = char_classes[code] if code < 0x10000 else get_char_class(chars[line_end])
+        if is_line_start(code, char_class):
+            break
+        line_end += 1
+    return pick_argument_number(len(BACKSLASH_CHAR_PATTERN.findall(chars, char_index + 1, line_end)), number, other_numbers)
+
+
+# The body as a string with one character for every word (the opcodes are searched in it)
+def words_to_text(body, words):
+    text = str(body, "utf-16le", "surrogatepass")
+    if len(text) != len(words):
+        # Surrogate pairs were joined into one character, keep every word on its own
+        text = "".join(map(chr, words))
+    return text
+
+
+# Split a GS4 script payload into its offset table, body words and records
+# The commands are the opcodes of the mapping table, followed by their argument number of words
+# (for the commands with a range of argument numbers, the one the decoder would use for their line;
+# before the first section the decoder doesn't give commands their own line, so they get the first one there)
+def disassemble(data, mapping_table):
+    data = memoryview(data).cast('B')
+    count = int.from_bytes(data[:2], "little")
+    table_size = min((2 + count * 2) * 2, len(data) & ~1)
+    body_size = (len(data) - table_size) & ~1
+
+    body = data[table_size:table_size + body_size]
+    table = bytes_to_words(data[:table_size])
+    words = bytes_to_words(body)
+    tail = bytes(data[table_size + body_size:])
+
+    regex, arguments, ranges = get_opcode_pattern(mapping_table)
+    text = words_to_text(body, words)
+    num_words = len(words)
+    # For the commands with other argument numbers, the payload is read the way the decoder does:
+    # only the commands after the first section start their own line there
+    section_chars = []
+    if ranges and len(data) > 2:
+        chars = str(data, "utf-16le", "replace")
+        sections_zero, sections_one = read_position_values(data)
+        section_chars = [char_index for char_index, kind in merge_markers(sections_zero, sections_one, len(chars))
+                         if kind == MARKER_SECTION]
+    if section_chars:
+        # Word indexes of the characters outside the BMP, to find the character index of a word
+        astral_words = [char_index + i for i, char_index in
+                        enumerate(match.start() for match in ASTRAL_CHAR_PATTERN.finditer(chars))]
+        table_words = table_size // 2
+
+    kinds = array.array('B')
+    starts = array.array('I')
+    cursor = 0  # End of the last record
+    for match in regex.finditer(text):
+        index = match.start()
+        if index < cursor:
+            continue  # An argument of the last command
+        if index > cursor:
+            kinds.append(OP_TEXT)
+            starts.append(cursor)
+        kinds.append(OP_COMMAND)
+        starts.append(index)
+        opcode = words[index]
+        number = arguments[opcode]
+        if opcode in ranges and section_chars:
+            char_index = table_words + index
+            char_index -= bisect.bisect_left(astral_words, char_index)
+            if char_index >= section_chars[0]:
+                number = get_range_arguments(chars, char_index, section_chars, number, ranges[opcode])
+        cursor = min(index + 1 + number, num_words)
+
+    if cursor < num_words:
+        kinds.append(OP_TEXT)
+        starts.append(cursor)
+    starts.append(num_words)
+
+    return Script(table, words, kinds, starts, tail)
+
+
+# Build the GS4 script payload again
+def assemble(script):
+    return words_to_bytes(script.table) + words_to_bytes(script.words) + script.tail
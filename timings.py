@@ -0,0 +1,151 @@
+import cProfile
+import contextlib
+import functools
+import json
+import time
+
+
+# Per stage timings of the conversions (--timings, --trace, --profile)
+# The stages are the functions marked with @timed / @timed_generator, and every stage only counts its own time
+# (a stage running inside another one, or a generator being consumed, is not counted twice)
+# Nothing is recorded (and there's no overhead but one check per call) until it's enabled
+enabled = False
+
+stats = {}  # stage name -> [seconds, calls, size]
+stack = []  # [stage name, start time] of the running stages
+
+
+def enter(name):
+    now = time.perf_counter()
+    if stack:
+        parent = stack[-1]
+        stats.setdefault(parent[0], [0.0, 0, 0])[0] += now - parent[1]
+    stack.append([name, now])
+
+
+def leave(calls=0, size=0):
+    now = time.perf_counter()
+    name, start = stack.pop()
+    stage = stats.setdefault(name, [0.0, 0, 0])
+    stage[0] += now - start
+    stage[1] += calls
+    stage[2] += size
+    if stack:
+        stack[-1][1] = now
+
+
+# Mark a function as a stage, size(result) gives the size (in bytes or characters) it processed
+def timed(name, size=None):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            enter(name)
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                leave(1, size(result) if size and result is not None else 0)
+        return wrapper
+    return decorate
+
+
+# Mark a generator function as a stage, every item it yields is timed (size(item) as above)
+def timed_generator(name, size=None):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            return iterate(name, func(*args, **kwargs), size)
+        return wrapper
+    return decorate
+
+
+def iterate(name, iterator, size):
+    calls = 1
+    while True:
+        enter(name)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            leave(calls)
+            return
+        except BaseException:
+            leave(calls)
+            raise
+        leave(calls, size(item) if size else 0)
+        calls = 0
+        yield item
+
+
+# Convert one file with the timings enabled, returns (result, timings of the file)
+# (top level, so it can run in the worker processes of --jobs)
+def measure(func, path):
+    global enabled
+    enabled = True
+    stats.clear()
+    stack.clear()
+
+    enter("other")
+    try:
+        result = func(path)
+    finally:
+        leave(1)
+    return result, {name: list(stage) for name, stage in stats.items()}
+
+
+# Add up the timings of the files
+def aggregate(report):
+    total = {}
+    for file_stats in report.values():
+        for name, (seconds, calls, size) in file_stats.items():
+            stage = total.setdefault(name, [0.0, 0, 0])
+            stage[0] += seconds
+            stage[1] += calls
+            stage[2] += size
+    return total
+
+
+def print_report(report):
+    print(f"{'file':<48}{'ms':>10}  slowest stage")
+    for path, file_stats in report.items():
+        total_ms = sum(stage[0] for stage in file_stats.values()) * 1000
+        slowest = max(file_stats, key=lambda name: file_stats[name][0])
+        print(f"{path:<48}{total_ms:>10.1f}  {slowest} ({file_stats[slowest][0] * 1000:.1f} ms)")
+
+    total = aggregate(report)
+    total_seconds = sum(stage[0] for stage in total.values()) or 1
+    print()
+    print(f"{'stage':<24}{'ms':>10}{'%':>7}{'calls':>9}{'size':>12}")
+    for name, (seconds, calls, size) in sorted(total.items(), key=lambda item: -item[1][0]):
+        print(f"{name:<24}{seconds * 1000:>10.1f}{seconds * 100 / total_seconds:>7.1f}{calls:>9}{size:>12}")
+
+
+# Save the timings of every file and their total as JSON
+def save_report(report, trace_file):
+    def to_json(file_stats):
+        return {name: {"seconds": seconds, "calls": calls, "size": size}
+                for name, (seconds, calls, size) in file_stats.items()}
+
+    with open(trace_file, 'w', encoding='utf-8') as file:
+        json.dump({"files": {path: to_json(file_stats) for path, file_stats in report.items()},
+                   "total": to_json(aggregate(report))}, file, indent=1)
+
+
+# Run the conversions under cProfile and dump the stats to the file (if one is given)
+@contextlib.contextmanager
+def profiled(profile_file):
+    if not profile_file:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file)